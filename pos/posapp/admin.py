@@ -117,9 +117,13 @@ class TabAdmin(admin.ModelAdmin):
     ordering = ['openedAt', 'closedAt']
     inlines = [TabProductInline]
 
+    def save_related(self, request, form, formsets, change):
+        super(TabAdmin, self).save_related(request, form, formsets, change)
+        form.instance.rebuild_totals()
+
 
 class ProductInTabAdmin(admin.ModelAdmin):
-    list_display = ['product', 'tab', 'state', 'price']
+    list_display = ['product', 'tab', 'state', 'quantity', 'price']
     list_filter = ['product', 'tab', 'state', 'price']
     ordering = ['tab', 'state']
 
@@ -184,6 +188,28 @@ class ExpenseAdmin(admin.ModelAdmin):
     readonly_fields = ['requested_at', 'state']
 
 
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'group', 'createdAt', 'attempts', 'nextAttemptAt']
+    search_fields = ['group']
+    ordering = ['createdAt']
+
+
+class TillLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'sequence', 'kind', 'amount', 'paid', 'edited', 'createdAt']
+    list_filter = ['kind']
+    ordering = ['count', 'sequence']
+
+    # The ledger is append-only, see TillLedgerEntry
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(User, UserAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(UnitGroup, UnitGroupAdmin)
@@ -198,3 +224,5 @@ admin.site.register(Deposit, DepositAdmin)
 admin.site.register(Till, TillAdmin)
 # admin.site.register(PaymentInOrder, PaymentInOrderAdmin)
 admin.site.register(Expense, ExpenseAdmin)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
+admin.site.register(TillLedgerEntry, TillLedgerEntryAdmin)
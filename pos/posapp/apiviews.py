@@ -1,18 +1,46 @@
+import json
+
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
-from posapp.models import Tab, Product, User, PaymentMethod, Currency, ProductInTab, Deposit
+from posapp.models import Tab, Product, User, PaymentMethod, Currency, ProductInTab, Deposit, SyncedOrder
+from posapp.pagination import apply_cursor, encode_cursor
 from posapp.security.role_decorators import ManagerLoginRequiredMixin, WaiterLoginRequiredMixin
 from posapp.serializers import TabListSerializer
 
 
+def stream_tab_list(tabs, page_length):
+    yield '{"results": ['
+    last = None
+    has_next = False
+    for i, tab in enumerate(tabs[:page_length + 1].iterator()):
+        if i == page_length:
+            has_next = True
+            break
+        yield ("," if last else "") + json.dumps(TabListSerializer(tab).data, cls=JSONEncoder)
+        last = tab
+    yield '], "next": ' + json.dumps(encode_cursor(last, "openedAt") if has_next else None) + '}'
+
+
+def tab_list_response(request, tabs):
+    try:
+        page_length = min(int(request.query_params.get("page_length", 100)), 1000)
+        tabs = apply_cursor(tabs, "openedAt", request.query_params.get("cursor", ""))
+    except ValueError:
+        return Response("Invalid cursor or page_length", status.HTTP_400_BAD_REQUEST)
+    tabs = tabs.annotate(total_spent=F("orderedTotal") - F("voidedTotal"))
+    return StreamingHttpResponse(stream_tab_list(tabs, max(page_length, 1)), content_type="application/json")
+
+
 class OpenTabs(WaiterLoginRequiredMixin, APIView):
     def get(self, request, format=None):
-        tabs = Tab.objects.filter(state=Tab.OPEN)
-        serializer = TabListSerializer(tabs, many=True)
-        return Response(serializer.data)
+        return tab_list_response(request, Tab.objects.filter(state=Tab.OPEN))
 
     def post(self, request, format=None):
         created = []
@@ -30,9 +58,16 @@ class OpenTabs(WaiterLoginRequiredMixin, APIView):
 
 class AllTabs(WaiterLoginRequiredMixin, APIView):
     def get(self, request, format=None):
-        tabs = Tab.objects.all()
-        serializer = TabListSerializer(tabs, many=True)
-        return Response(serializer.data)
+        return tab_list_response(request, Tab.objects.all())
+
+
+class TabState(WaiterLoginRequiredMixin, APIView):
+    def get(self, request, id, format=None):
+        try:
+            tab = Tab.objects.get(id=id)
+        except Tab.DoesNotExist:
+            return Response("Tab not found", status.HTTP_404_NOT_FOUND)
+        return Response(tab.state_update())
 
 
 class TabOrder(APIView):
@@ -55,14 +90,156 @@ class TabOrder(APIView):
         return Response("", status.HTTP_201_CREATED)
 
 
+def is_order_line(line):
+    # The fields of an order line with the types the ordering code expects, ids are looked up as strings
+    return isinstance(line, dict) and \
+        isinstance(line.get("product"), str) and \
+        type(line.get("amount")) is int and \
+        "note" in line and (line["note"] is None or isinstance(line["note"], str)) and \
+        isinstance(line.get("state"), str)
+
+
+class TabBatchOrder(WaiterLoginRequiredMixin, APIView):
+    def post(self, request, id, format=None):
+        if not isinstance(request.data, list) or not request.data:
+            return Response("Expected a non-empty list of order lines", status.HTTP_400_BAD_REQUEST)
+        for line in request.data:
+            if not is_order_line(line):
+                return Response("Parts of JSON are missing or invalid", status.HTTP_400_BAD_REQUEST)
+        try:
+            tab = Tab.objects.get(id=id, state=Tab.OPEN)
+        except Tab.DoesNotExist:
+            return Response("Tab not found", status.HTTP_404_NOT_FOUND)
+        try:
+            products = Product.objects.in_bulk({line["product"] for line in request.data})
+        except ValidationError:
+            return Response("Product not found", status.HTTP_404_NOT_FOUND)
+        products = {str(key): product for key, product in products.items()}
+        lines = []
+        for line in request.data:
+            product = products.get(str(line["product"]))
+            if product is None:
+                return Response("Product not found", status.HTTP_404_NOT_FOUND)
+            lines.append((product, line["amount"], line["note"], line["state"]))
+        try:
+            tab.order_products(lines, request.user)
+        except ValidationError as err:
+            return Response(err.message, status.HTTP_406_NOT_ACCEPTABLE)
+        return Response("", status.HTTP_201_CREATED)
+
+
+class OrderSync(WaiterLoginRequiredMixin, APIView):
+    class Failed(Exception):
+        def __init__(self, keys, message, code):
+            self.keys = keys
+            self.message = message
+            self.code = code
+
+    def post(self, request, format=None):
+        operations = request.data.get("operations") if isinstance(request.data, dict) else None
+        if not isinstance(operations, list):
+            return Response("Expected a list of operations", status.HTTP_400_BAD_REQUEST)
+        for operation in operations:
+            if not isinstance(operation, dict) or \
+                    not isinstance(operation.get("key"), str) or \
+                    not 0 < len(operation["key"]) <= 64:
+                return Response("Parts of JSON are missing", status.HTTP_400_BAD_REQUEST)
+        for operation in operations:
+            # Reported by key, so the client drops the operation instead of resending it forever
+            if not isinstance(operation.get("tab"), str) or not is_order_line(operation):
+                return Response({"keys": [operation["key"]], "error": "Parts of the order are missing or invalid"},
+                                status.HTTP_400_BAD_REQUEST)
+
+        # A batch racing a resend of the same keys may still lose on the key's primary key where tabs can't be
+        # locked (SQLite), it is then applied again and those keys come back as skipped
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    applied, skipped, versions = self.apply(request.user, operations)
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+            except OrderSync.Failed as err:
+                return Response({"keys": err.keys, "error": err.message}, err.code)
+        return Response({"applied": applied, "skipped": skipped, "tabs": versions}, status.HTTP_200_OK)
+
+    # Applies the operations in order, skipping every key that was already synced. Any failure rolls back the
+    # whole batch, so the client can safely resend it.
+    def apply(self, user, operations):
+        keys = [operation["key"] for operation in operations]
+        # Lock the tabs first, a concurrent resend of the same keys waits here until this batch is recorded
+        try:
+            list(Tab.objects.select_for_update().filter(pk__in={operation["tab"] for operation in operations}))
+        except ValidationError:
+            pass
+        seen = set(SyncedOrder.objects.filter(key__in=keys).values_list("key", flat=True))
+        pending = []
+        skipped = []
+        for operation in operations:
+            if operation["key"] in seen:
+                skipped.append(operation["key"])
+            else:
+                seen.add(operation["key"])
+                pending.append(operation)
+
+        tabs = self.resolve(Tab.objects.select_for_update().filter(state=Tab.OPEN), pending, "tab", "Tab")
+        products = self.resolve(Product.objects.all(), pending, "product", "Product")
+
+        synced = []
+        for group in self.rounds(pending):
+            tab = tabs[str(group[0]["tab"])]
+            try:
+                tab.order_products([(products[str(operation["product"])], operation["amount"], operation["note"],
+                                     operation["state"]) for operation in group], user)
+            except ValidationError as err:
+                raise OrderSync.Failed([operation["key"] for operation in group], err.message,
+                                       status.HTTP_406_NOT_ACCEPTABLE)
+            synced += [SyncedOrder(key=operation["key"], tab=tab, waiter=user, version=tab.version)
+                       for operation in group]
+        SyncedOrder.objects.bulk_create(synced)
+
+        versions = {str(tab_id): version for tab_id, version in
+                    Tab.objects.filter(syncedorder__key__in=keys).values_list("id", "version").distinct()}
+        return [order.key for order in synced], skipped, versions
+
+    @staticmethod
+    def resolve(queryset, operations, field, name):
+        try:
+            objects = {str(key): obj for key, obj in
+                       queryset.in_bulk({operation[field] for operation in operations}).items()}
+        except ValidationError:
+            objects = {}
+        for operation in operations:
+            if str(operation[field]) not in objects:
+                raise OrderSync.Failed([operation["key"]], f"{name} not found", status.HTTP_404_NOT_FOUND)
+        return objects
+
+    # Consecutive operations of one tab sharing a "round" were submitted together and become a single ticket
+    @staticmethod
+    def rounds(operations):
+        group = []
+        for operation in operations:
+            if group and (operation.get("round") is None or
+                          (operation["tab"], operation["round"]) != (group[0]["tab"], group[0].get("round"))):
+                yield group
+                group = []
+            group.append(operation)
+        if group:
+            yield group
+
+
 class Orders:
     class Order:
         class Void(ManagerLoginRequiredMixin, APIView):
             def get(self, request, id, format=None):
                 try:
+                    quantity = int(request.query_params.get("quantity", 1))
                     order = ProductInTab.objects.get(id=id)
-                    order.void()
+                    order.void(quantity)
                     return Response(status=status.HTTP_200_OK)
+                except ValueError:
+                    return Response("quantity must be a whole number", status=status.HTTP_400_BAD_REQUEST)
                 except ProductInTab.DoesNotExist:
                     return Response(status=status.HTTP_404_NOT_FOUND)
                 except ValidationError as err:
@@ -1,5 +1,4 @@
 from django.apps import AppConfig
-from django.db import OperationalError, ProgrammingError
 
 
 class PosappConfig(AppConfig):
@@ -7,8 +6,5 @@ class PosappConfig(AppConfig):
     verbose_name = 'PUDA POS Point-of-sale'
 
     def ready(self):
-        User = self.get_model('User')
-        try:
-            User.objects.all().update(online_counter=0)
-        except (OperationalError, ProgrammingError):
-            print("Database is not yet created. We can ignore this, as the counters will start at zero anyway.")
+        from posapp import counters  # connects the signal receivers keeping the counters up to date
+        from posapp import presence  # registers the presence store check
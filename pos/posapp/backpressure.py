@@ -0,0 +1,116 @@
+import collections
+
+from django.core.cache import cache
+
+# A stream socket sends at most STREAM_SEND_WINDOW messages the client hasn't acknowledged yet, the rest wait in its
+# outbound queue. A client that stops reading (a handheld in a dead spot) so only costs a bounded queue, and its
+# channel keeps being drained, so it never fills up the channel layer.
+
+# Close code of sockets whose queue overflowed, the client reconnects and resyncs its topics
+SLOW_CLIENT_CLOSE_CODE = 4408
+
+
+def merge_presence(queued, new):
+    return {**new, "updates": {**queued["updates"], **new["updates"]}}
+
+
+def merge_tab_states(queued, new):
+    # Either may be newer, lines of the newer state win
+    older, newer = sorted((queued, new), key=lambda state: state["version"])
+    lines = {(line["product"], line["note"]): line for line in older["lines"] + newer["lines"]}
+    return {**newer, "lines": list(lines.values())}
+
+
+def replace(queued, new):
+    return new
+
+
+class OutboundQueue:
+    # A message pushed with a merge function is merged into the queued message of the same topic and notification
+    # type instead of waiting behind it. Once the queue is over its limit it gives up: everything queued is dropped,
+    # further pushes are refused and the socket should be closed.
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.deque()
+        self.mergeable = {}
+        self.overflowed = False
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.peak = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(entry):
+        return entry["topic"], entry["data"].get("notification_type")
+
+    # Returns whether the message was queued
+    def push(self, topic, data, merge=None):
+        if self.overflowed:
+            self.dropped += 1
+            return False
+        entry = {"topic": topic, "data": data}
+        queued = self.mergeable.get(self.key(entry)) if merge is not None else None
+        if queued is not None:
+            queued["data"] = merge(queued["data"], data)
+            self.coalesced += 1
+            return True
+        if len(self.entries) >= self.limit:
+            self.overflowed = True
+            self.dropped += len(self.entries) + 1
+            self.entries.clear()
+            self.mergeable.clear()
+            return False
+
+        self.entries.append(entry)
+        if merge is not None:
+            self.mergeable[self.key(entry)] = entry
+        self.queued += 1
+        self.peak = max(self.peak, len(self.entries))
+        return True
+
+    def pop(self):
+        entry = self.entries.popleft()
+        if self.mergeable.get(self.key(entry)) is entry:
+            del self.mergeable[self.key(entry)]
+        return entry
+
+
+# Totals over all sockets closed so far, kept in the cache so every socket process adds to the numbers the
+# stream_metrics command reads, which needs a shared CACHE_BACKEND like presence does. The sums use the cache's atomic
+# incr, only the peak is a plain read and write and may miss a racing higher peak.
+METRICS = ("connections", "queued", "coalesced", "dropped", "slow_closes", "peak_queue")
+
+
+def metric_key(name):
+    return f"posapp_stream-metrics-{name}"
+
+
+def add_metric(name, value):
+    key = metric_key(name)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # Evicted in between
+        cache.set(key, value, None)
+
+
+def record_metrics(outbound):
+    for name, value in (("connections", 1), ("queued", outbound.queued), ("coalesced", outbound.coalesced),
+                        ("dropped", outbound.dropped), ("slow_closes", int(outbound.overflowed))):
+        if value:
+            add_metric(name, value)
+    if outbound.peak > (cache.get(metric_key("peak_queue")) or 0):
+        cache.set(metric_key("peak_queue"), outbound.peak, None)
+
+
+def get_metrics():
+    values = cache.get_many([metric_key(name) for name in METRICS])
+    return {name: values.get(metric_key(name), 0) for name in METRICS}
+
+
+def reset_metrics():
+    cache.delete_many([metric_key(name) for name in METRICS])
@@ -1,101 +1,156 @@
-import logging
-
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
-from django.core.exceptions import ValidationError
-from django.db.models import F
-
-from posapp.models import User
-
-logger = logging.getLogger(__name__)
-
-
-class Notifications:
-    class User(JsonWebsocketConsumer):
-        def connect(self):
-            self.user = self.scope["user"]
-
-            if not self.user.is_authenticated:
-                self.close(4401)
-            else:
-                self.accept()
-
-            async_to_sync(self.channel_layer.group_add)(f"notifications_user-{self.user.id}", self.channel_name)
-            async_to_sync(self.channel_layer.group_add)(f"notifications_users", self.channel_name)
-            try:
-                User.objects.filter(pk=self.user.pk).update(online_counter=F('online_counter') + 1)
-                self.user.refresh_from_db()
-                async_to_sync(self.channel_layer.group_send)(
-                    "notifications_users",
-                    {
-                        "type": "online_status.update",
-                        "update": {
-                            "username": self.user.username,
-                            "new_count": self.user.online_counter,
-                        },
-                    },
-                )
-            except ValidationError as err:
-                logger.error(f"Failed to increase user online count: {err.message}")
-
-        def disconnect(self, code):
-            async_to_sync(self.channel_layer.group_discard)(f"notifications_user-{self.user.id}", self.channel_name)
-            async_to_sync(self.channel_layer.group_discard)(f"notifications_users", self.channel_name)
-            try:
-                User.objects.filter(pk=self.user.pk).update(online_counter=F('online_counter') - 1)
-                self.user.refresh_from_db()
-                async_to_sync(self.channel_layer.group_send)(
-                    "notifications_users",
-                    {
-                        "type": "online_status.update",
-                        "update": {
-                            "username": self.user.username,
-                            "new_count": self.user.online_counter,
-                        },
-                    },
-                )
-            except ValidationError as err:
-                logger.error(f"Failed to decrease user online count: {err.message}")
-
-        def notification_void_request_resolved(self, event):
-            void_request = event["void_request"]
-            print(f"sent resolution to {self.user.username}")
-            self.send_json(void_request)
-
-        def notification_tab_transfer_request_resolved(self, event):
-            self.send_json({
-                "notification_type": "tab_transfer_request_resolved",
-                "message": event["message"],
-                "resolution": event["resolution"],
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from posapp import presence, backpressure
+from posapp.models import Tab, UserNotification
+
+# The most notifications replayed to a reconnecting socket, older ones are skipped
+REPLAY_LIMIT = 100
+
+
+async def touch_presence(username, connection):
+    if await database_sync_to_async(presence.get_store().touch)(username, connection):
+        presence.get_broadcaster().announce(username)
+
+
+async def remove_presence(username, connection):
+    await database_sync_to_async(presence.get_store().remove)(username, connection)
+    presence.get_broadcaster().announce(username)
+
+
+@database_sync_to_async
+def missed_notifications(user, after):
+    # Returns the notifications after the cursor and the cursor to resume from next time. Without a cursor nothing is
+    # missed, the socket only learns where to start.
+    entries = UserNotification.objects.filter(user=user)
+    if after is None:
+        return [], entries.order_by("-id").values_list("id", flat=True).first() or 0
+    entries = list(reversed(entries.filter(id__gt=after).order_by("-id")[:REPLAY_LIMIT]))
+    return [entry.notification for entry in entries], entries[-1].id if entries else after
+
+
+def parse_cursor(value):
+    return int(value) if isinstance(value, int) or (isinstance(value, str) and value.isdigit()) else None
+
+
+class Stream(AsyncJsonWebsocketConsumer):
+    # The one socket a page opens. The client subscribes to topics and every message it gets is wrapped as
+    # {"topic": ..., "data": ..., "seq": ...}. A topic maps to a channel group, joined only while subscribed. The
+    # client acknowledges the sequence of what it has handled, see backpressure.
+    TOPICS = {
+        "user": (lambda user: True, lambda user, content: f"notifications_user-{user.id}"),
+        "manager": (lambda user: user.is_manager, lambda user, content: "notifications_manager"),
+        "orders": (lambda user: user.is_waiter, lambda user, content: "orders"),
+        "tab": (lambda user: user.is_waiter, lambda user, content: Tab.group_name(uuid.UUID(str(content["id"])))),
+    }
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.subscriptions = {}
+        self.outbound = backpressure.OutboundQueue(settings.STREAM_QUEUE_LIMIT)
+        self.sent = 0
+        self.acknowledged = 0
+        self.closing = False
+
+        if not self.user.is_authenticated:
+            await self.close(4401)
+            return
+        await self.accept()
+        await touch_presence(self.user.username, self.channel_name)
+
+    async def disconnect(self, code):
+        if not self.user.is_authenticated:
+            return
+        for group in self.subscriptions.values():
+            await self.channel_layer.group_discard(group, self.channel_name)
+        await remove_presence(self.user.username, self.channel_name)
+        await database_sync_to_async(backpressure.record_metrics)(self.outbound)
+
+    @staticmethod
+    def topic_key(content):
+        # Tabs are subscribed one by one, each under its own key
+        if content.get("topic") != "tab":
+            return content.get("topic")
+        try:
+            return f"tab:{uuid.UUID(str(content.get('id')))}"
+        except ValueError:
+            return f"tab:{content.get('id')}"
+
+    async def receive_json(self, content, **kwargs):
+        if content.get("type") == "heartbeat":
+            await touch_presence(self.user.username, self.channel_name)
+        elif content.get("type") == "ack":
+            seq = parse_cursor(content.get("seq"))
+            if seq is not None and self.acknowledged < seq <= self.sent:
+                self.acknowledged = seq
+                await self.flush()
+        elif content.get("type") == "subscribe":
+            await self.subscribe(content)
+        elif content.get("type") == "unsubscribe":
+            group = self.subscriptions.pop(self.topic_key(content), None)
+            if group:
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def subscribe(self, content):
+        key = self.topic_key(content)
+        if content.get("topic") not in self.TOPICS:
+            return await self.send_topic(key, {"notification_type": "subscription_refused", "reason": "Unknown topic"})
+        allowed, group_name = self.TOPICS[content["topic"]]
+        if not allowed(self.user):
+            return await self.send_topic(key, {"notification_type": "subscription_refused", "reason": "Forbidden"})
+        try:
+            group = group_name(self.user, content)
+        except (KeyError, ValueError):
+            return await self.send_topic(key, {"notification_type": "subscription_refused", "reason": "Invalid id"})
+
+        if key not in self.subscriptions:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.subscriptions[key] = group
+        await self.send_topic(key, {"notification_type": "subscribed"})
+        if content["topic"] == "user":
+            # Joined the group first, a notification sent meanwhile may arrive twice but never gets lost. Clients
+            # ignore sequences they have already seen.
+            notifications, cursor = await missed_notifications(self.user, parse_cursor(content.get("after")))
+            await self.send_topic(key, {
+                "notification_type": "inbox_replay",
+                "notifications": notifications,
+                "cursor": cursor,
             })
 
-        def online_status_update(self, event):
-            self.send_json({
-                "notification_type": "online_status_update",
-                "update": event["update"],
-            })
+    async def send_topic(self, topic, data, merge=None):
+        if self.outbound.push(topic, data, merge):
+            await self.flush()
+        elif not self.closing:
+            # Stayed over the limit even with superseded messages merged, the client resyncs after reconnecting
+            self.closing = True
+            await self.close(backpressure.SLOW_CLIENT_CLOSE_CODE)
+
+    async def flush(self):
+        while self.outbound and self.sent - self.acknowledged < settings.STREAM_SEND_WINDOW:
+            self.sent += 1
+            await self.send_json({**self.outbound.pop(), "seq": self.sent})
 
-    class Manager(JsonWebsocketConsumer):
-        groups = ["notifications_manager"]
+    async def notification_inbox(self, event):
+        await self.send_topic("user", event["notification"])
 
-        def connect(self):
-            self.user = self.scope["user"]
+    async def notification_void_request(self, event):
+        await self.send_topic("manager", event["void_request"])
 
-            if not self.user.is_authenticated:
-                self.close(4401)
-            elif not self.user.is_manager:
-                self.close(4403)
-            else:
-                self.accept()
-                # async_to_sync(self.channel_layer.group_add)("notifications_manager", self.channel_name)
+    async def notification_tab_transfer_request(self, event):
+        await self.send_topic("manager", event["tab_transfer_request"])
 
-        def disconnect(self, code):
-            async_to_sync(self.channel_layer.group_discard)("notifications_manager", self.channel_name)
+    async def online_status_update(self, event):
+        await self.send_topic("manager", {
+            "notification_type": "online_status_update",
+            "updates": event["updates"],
+        }, backpressure.merge_presence)
 
-        def notification_void_request(self, event):
-            void_request = event["void_request"]
-            self.send_json(void_request)
+    async def order_update(self, event):
+        # Only a hint to refetch the board, one waiting hint is enough
+        await self.send_topic("orders", event["update"], backpressure.replace)
 
-        def notification_tab_transfer_request(self, event):
-            transfer_request = event["tab_transfer_request"]
-            self.send_json(transfer_request)
+    async def tab_update(self, event):
+        await self.send_topic(f"tab:{event['update']['tab']}", event["update"], backpressure.merge_tab_states)
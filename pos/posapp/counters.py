@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from posapp.models import OrderVoidRequest, TabTransferRequest
+
+# Counts of unresolved requests shown in the manager header. Every page a manager opens reads them, so they are
+# kept in the cache and refreshed whenever a request is saved or deleted. The timeout limits how stale a counter
+# can get if the cache isn't shared between processes.
+TIMEOUT = 5 * 60
+
+VOID_REQUESTS = "void_requests"
+TRANSFER_REQUESTS = "transfer_requests"
+
+QUERIES = {
+    VOID_REQUESTS: lambda: OrderVoidRequest.objects.filter(resolution__isnull=True),
+    TRANSFER_REQUESTS: lambda: TabTransferRequest.objects.all(),
+}
+
+
+def cache_key(name):
+    return f"posapp_counter-{name}"
+
+
+def refresh_count(name):
+    count = QUERIES[name]().count()
+    cache.set(cache_key(name), count, TIMEOUT)
+    return count
+
+
+def get_counts(*names):
+    cached = cache.get_many([cache_key(name) for name in names])
+    return {name: cached[cache_key(name)] if cache_key(name) in cached else refresh_count(name) for name in names}
+
+
+def invalidate(name):
+    # Dropped right away so nothing reads the old value, refilled once the change is visible to other connections
+    cache.delete(cache_key(name))
+    transaction.on_commit(lambda: refresh_count(name))
+
+
+@receiver([post_save, post_delete], sender=OrderVoidRequest)
+def invalidate_void_requests(sender, **kwargs):
+    invalidate(VOID_REQUESTS)
+
+
+@receiver([post_save, post_delete], sender=TabTransferRequest)
+def invalidate_transfer_requests(sender, **kwargs):
+    invalidate(TRANSFER_REQUESTS)
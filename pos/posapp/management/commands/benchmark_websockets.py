@@ -0,0 +1,243 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+from django.urls import reverse
+
+from posapp import outbox
+from posapp.models import User, Tab, Product, ProductInTab, OrderVoidRequest, TabTransferRequest
+from puda.routing import application
+
+STREAM_PATH = "/ws/posapp/stream"
+# Topics a page subscribes to, the same as _base.html does
+USER_TOPICS = ["user"]
+MANAGER_TOPICS = ["user", "manager"]
+EVENTS = ["void request", "void resolved", "transfer request", "presence"]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def milliseconds(start, end):
+    return (end - start) * 1000
+
+
+class Command(BaseCommand):
+    help = "Opens many user and manager sockets through the full ASGI application, fires void request, transfer " \
+           "request and presence events and reports connect cost, fan-out latency and memory per connection. " \
+           "Runs against a throwaway test database and the in-memory channel layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, nargs="+", default=[100, 500, 1000],
+                            help="Numbers of concurrent user sockets to try")
+        parser.add_argument("--users", type=int, default=20,
+                            help="Number of waiters the user sockets are spread across")
+        parser.add_argument("--managers", type=int, default=5, help="Number of manager sockets")
+        parser.add_argument("--events", type=int, default=10, help="Number of events of each kind to fire")
+        parser.add_argument("--memory-sample", type=int, default=200,
+                            help="Number of extra sockets opened to measure memory per connection")
+        parser.add_argument("--timeout", type=float, default=120, help="Seconds a single connect or delivery may take")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        if connection.vendor == "sqlite":
+            # The shared in-memory database locks whole tables, every socket would wait for the others
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), "posapp_benchmark.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # Outbox messages are dispatched by the benchmark itself, on its own event loop. Everything runs in this one
+        # process, so presence is kept in memory rather than in whatever store the settings pick.
+        overrides = override_settings(OUTBOX_DISPATCH_IN_PROCESS=False,
+                                      PRESENCE_STORE="posapp.presence.MemoryPresenceStore",
+                                      CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+        overrides.enable()
+        try:
+            self.timeout = options["timeout"]
+            self.create_world(options["users"], options["managers"])
+            loop = asyncio.get_event_loop()
+            for count in options["sockets"]:
+                result = loop.run_until_complete(self.measure(count, options["events"], options["memory_sample"]))
+                self.report(count, result)
+        finally:
+            overrides.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def create_world(self, users, managers):
+        self.waiters = [User.objects.create_user(username=f"benchmark{i}", password="benchmark", is_waiter=True)
+                        for i in range(users)]
+        self.managers = [User.objects.create_user(username=f"manager{i}", password="benchmark", is_waiter=True,
+                                                  is_manager=True) for i in range(managers)]
+        self.product = Product.objects.create(name="Benchmark", price=Decimal(10))
+        self.cookies = {}
+        for user in self.waiters + self.managers:
+            client = Client()
+            client.force_login(user)
+            self.cookies[user.pk] = client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def communicator(self, user, topics):
+        communicator = WebsocketCommunicator(application, STREAM_PATH, headers=[
+            (b"cookie", f"{settings.SESSION_COOKIE_NAME}={self.cookies[user.pk]}".encode()),
+        ])
+        communicator.topics = topics
+        return communicator
+
+    async def connect(self, communicators):
+        async def connect_one(communicator):
+            start = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=self.timeout)
+            if not connected:
+                raise RuntimeError("A benchmark socket was refused")
+            for topic in communicator.topics:
+                await communicator.send_json_to({"type": "subscribe", "topic": topic})
+                await self.receive(communicator, "subscribed")
+            return milliseconds(start, time.perf_counter())
+
+        return await asyncio.gather(*map(connect_one, communicators))
+
+    async def receive(self, communicator, notification_type):
+        # Skips whatever else the socket got meanwhile, returns when the wanted message arrived
+        while True:
+            message = await communicator.receive_json_from(timeout=self.timeout)
+            received = time.perf_counter()
+            # Acknowledged like a page does, or the socket would stop sending once its window is full
+            await communicator.send_json_to({"type": "ack", "seq": message["seq"]})
+            if message["data"].get("notification_type") == notification_type:
+                return received
+
+    async def fan_out(self, fire, communicators, notification_type):
+        waiting = [asyncio.ensure_future(self.receive(communicator, notification_type))
+                   for communicator in communicators]
+        start = time.perf_counter()
+        await fire()
+        return [milliseconds(start, end) for end in await asyncio.gather(*waiting)]
+
+    @staticmethod
+    async def drain(communicators):
+        async def drain_one(communicator):
+            while not await communicator.receive_nothing(timeout=0.01):
+                message = await communicator.receive_json_from()
+                await communicator.send_json_to({"type": "ack", "seq": message["seq"]})
+
+        await asyncio.gather(*map(drain_one, communicators))
+
+    async def measure(self, count, events, memory_sample):
+        users = [self.communicator(self.waiters[i % len(self.waiters)], USER_TOPICS) for i in range(count)]
+        managers = [self.communicator(manager, MANAGER_TOPICS) for manager in self.managers]
+        owner = self.waiters[0]
+        owner_sockets = users[::len(self.waiters)]
+
+        start = time.perf_counter()
+        latencies = await self.connect(users + managers)
+        connect_total = time.perf_counter() - start
+        # Let the initial presence batch go out so it isn't counted as an event
+        await asyncio.sleep(settings.PRESENCE_BROADCAST_DELAY * 2)
+        await self.drain(users + managers)
+
+        tabs = await sync_to_async(self.create_tabs)(owner, events)
+        fan_out = {event: [] for event in EVENTS}
+        for tab in tabs:
+            fan_out["void request"] += await self.fan_out(
+                lambda: sync_to_async(self.request_void)(owner, tab), managers, "void_request")
+            fan_out["void resolved"] += await self.fan_out(
+                lambda: sync_to_async(self.resolve_void)(tab), owner_sockets, "void_request_resolved")
+            fan_out["transfer request"] += await self.fan_out(
+                lambda: sync_to_async(self.request_transfer)(owner, tab), managers, "tab_transfer_request")
+            await sync_to_async(self.resolve_transfer)(tab)
+
+            extra = self.communicator(self.waiters[-1], USER_TOPICS)
+            fan_out["presence"] += await self.fan_out(lambda: self.connect([extra]), managers, "online_status_update")
+            await extra.disconnect()
+            await asyncio.sleep(settings.PRESENCE_BROADCAST_DELAY * 2)
+            await self.drain(users + managers)
+
+        memory = await self.measure_memory(memory_sample)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[communicator.disconnect(timeout=self.timeout) for communicator in users + managers])
+        close = time.perf_counter() - start
+        # Forget the channels of the closed sockets before the next round
+        await get_channel_layer().flush()
+
+        return {
+            "connect_total": connect_total,
+            "connect": latencies,
+            "memory": memory,
+            "close": close,
+            "fan_out": fan_out,
+            "targets": {"void request": len(managers), "void resolved": len(owner_sockets),
+                        "transfer request": len(managers), "presence": len(managers)},
+        }
+
+    async def measure_memory(self, count):
+        # Traced separately, tracemalloc would slow down the connects measured above
+        if count < 1:
+            return None
+        sockets = [self.communicator(self.waiters[i % len(self.waiters)], USER_TOPICS) for i in range(count)]
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        await self.connect(sockets)
+        await self.drain(sockets)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        await asyncio.gather(*[communicator.disconnect(timeout=self.timeout) for communicator in sockets])
+        return sum(stat.size_diff for stat in after.compare_to(before, "filename")) / count
+
+    def create_tabs(self, owner, count):
+        tabs = []
+        for i in range(count):
+            tab = Tab.objects.create(name=f"Benchmark {Tab.objects.count()}", owner=owner)
+            tab.order_product(self.product, 1, "", ProductInTab.ORDERED)
+            tabs.append(tab)
+        return tabs
+
+    def client(self, user):
+        client = Client()
+        client.cookies[settings.SESSION_COOKIE_NAME] = self.cookies[user.pk]
+        return client
+
+    def request_void(self, waiter, tab):
+        order = ProductInTab.objects.get(tab=tab)
+        self.client(waiter).get(reverse("waiter/orders/order/request_void", kwargs={"id": order.id}))
+        outbox.dispatch_pending()
+
+    def resolve_void(self, tab):
+        OrderVoidRequest.objects.get(order__tab=tab).reject(self.managers[0])
+        outbox.dispatch_pending()
+
+    def request_transfer(self, waiter, tab):
+        self.client(waiter).post(reverse("waiter/tabs/tab/request_transfer", kwargs={"id": tab.id}),
+                                 {"newOwnerUsername": self.waiters[-1].username})
+        outbox.dispatch_pending()
+
+    def resolve_transfer(self, tab):
+        TabTransferRequest.objects.get(tab=tab).reject(self.managers[0])
+        outbox.dispatch_pending()
+
+    def report(self, count, result):
+        connect = result["connect"]
+        self.stdout.write(f"{count} user sockets, {len(self.managers)} manager sockets")
+        self.stdout.write(f"  connect  total {result['connect_total']:.2f} s, p50 {statistics.median(connect):.1f} ms, "
+                          f"p95 {percentile(connect, 0.95):.1f} ms, max {max(connect):.1f} ms")
+        if result["memory"] is not None:
+            self.stdout.write(f"  memory   {result['memory'] / 1024:.1f} KiB per connection")
+        self.stdout.write(f"  close    {result['close']:.2f} s")
+        self.stdout.write(f"  {'event':<18} {'sockets':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for event, latencies in result["fan_out"].items():
+            if latencies:
+                self.stdout.write(f"  {event:<18} {result['targets'][event]:>8} {statistics.median(latencies):>8.1f} "
+                                  f"{percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f} "
+                                  f"{max(latencies):>8.1f}")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from posapp import outbox
+
+
+class Command(BaseCommand):
+    help = "Sends pending notification outbox messages to the channel layer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float,
+                            help="Keep running and dispatch every this many seconds instead of only once")
+        parser.add_argument("--batch-size", type=int, default=outbox.BATCH_SIZE,
+                            help="Number of messages claimed and sent at once")
+
+    def handle(self, *args, **options):
+        while True:
+            outbox.dispatch_pending(options["batch_size"])
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from posapp.models import UserNotification
+
+
+class Command(BaseCommand):
+    help = "Deletes user notifications older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.NOTIFICATION_RETENTION_DAYS,
+                            help="Keep notifications from this many last days")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        deleted, _ = UserNotification.objects.filter(createdAt__lt=cutoff).delete()
+        self.stdout.write(f"Deleted {deleted} notification(s)")
@@ -0,0 +1,30 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from posapp import presence
+
+
+class Command(BaseCommand):
+    help = "Expires websocket connections that stopped sending heartbeats and announces the new online counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float,
+                            help="Keep running and reap every this many seconds instead of only once")
+
+    def handle(self, *args, **options):
+        while True:
+            changed = presence.get_store().reap()
+            self.announce(changed)
+            if changed:
+                self.stdout.write(f"Reaped connections of {len(changed)} user(s)")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
+
+    @staticmethod
+    def announce(changed):
+        if changed:
+            async_to_sync(get_channel_layer().group_send)("notifications_manager", presence.broadcast_message(changed))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from posapp.models import Tab
+
+
+class Command(BaseCommand):
+    help = "Recalculates the running totals stored on tabs from their orders and payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only verify the stored totals, don't change anything")
+        parser.add_argument("--open", action="store_true", help="Only process tabs that are still open")
+
+    def handle(self, *args, **options):
+        tabs = Tab.objects.all()
+        if options["open"]:
+            tabs = tabs.filter(state=Tab.OPEN)
+
+        mismatched = 0
+        for tab in tabs.iterator():
+            with transaction.atomic():
+                tab = Tab.objects.select_for_update().get(pk=tab.pk)
+                totals = tab.calculate_totals()
+                differences = [f"{field} {getattr(tab, field)} != {value}" for field, value in totals.items()
+                               if getattr(tab, field) != value]
+                if not differences:
+                    continue
+                mismatched += 1
+                self.stdout.write(f"Tab {tab.name} ({tab.id}): {', '.join(differences)}")
+                if not options["check"]:
+                    tab.rebuild_totals()
+
+        if options["check"]:
+            if mismatched:
+                raise CommandError(f"{mismatched} tab(s) have stored totals that don't match their orders and payments")
+            self.stdout.write(self.style.SUCCESS("All tab totals are consistent"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt totals of {mismatched} tab(s)"))
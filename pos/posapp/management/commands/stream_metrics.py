@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from posapp import backpressure
+
+
+class Command(BaseCommand):
+    help = "Prints the outbound queue totals of closed stream sockets: messages queued, merged into superseded " \
+           "ones and dropped, sockets closed as too slow and the longest queue seen"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Start counting from zero afterwards")
+
+    def handle(self, *args, **options):
+        for name, value in backpressure.get_metrics().items():
+            self.stdout.write(f"{name:<12} {value}")
+        if options["reset"]:
+            backpressure.reset_metrics()
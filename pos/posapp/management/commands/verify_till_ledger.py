@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posapp.models import TillMoneyCount
+from posapp.tills import verify_ledger
+
+
+class Command(BaseCommand):
+    help = "Checks that till ledgers are unaltered and agree with the payments and edits they record"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--till", help="Check only the till with this id")
+        parser.add_argument("--full", action="store_true",
+                            help="Check every entry instead of those after the last snapshot")
+
+    def handle(self, *args, **options):
+        counts = TillMoneyCount.objects.select_related("paymentMethod")
+        if options["till"]:
+            counts = counts.filter(till_id=options["till"])
+        failed = 0
+        for count in counts:
+            problems = verify_ledger(count, options["full"])
+            for problem in problems:
+                self.stderr.write(f"Till {count.till_id}, {count.paymentMethod.name}: {problem}")
+            failed += bool(problems)
+        if failed:
+            raise CommandError(f"{failed} ledger(s) failed the check")
+        self.stdout.write("All ledgers are intact")
@@ -0,0 +1,46 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:42
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def fill_tab_totals(apps, schema_editor):
+    Tab = apps.get_model('posapp', 'Tab')
+    ProductInTab = apps.get_model('posapp', 'ProductInTab')
+    PaymentInTab = apps.get_model('posapp', 'PaymentInTab')
+    for tab in Tab.objects.all():
+        orders = ProductInTab.objects.filter(tab=tab)
+        tab.orderedTotal = orders.aggregate(sum=models.Sum('_price'))['sum'] or 0
+        tab.voidedTotal = orders.filter(state='V').aggregate(sum=models.Sum('_price'))['sum'] or 0
+        paid = Decimal(0)
+        for payment in PaymentInTab.objects.filter(tab=tab).select_related('method__paymentMethod__currency'):
+            paid += Decimal(str(round(float(payment.amount) * payment.method.paymentMethod.currency.ratio, 3)))
+        tab.paidTotal = paid
+        tab.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0031_member_squashed_0032_member_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tab',
+            name='orderedTotal',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='tab',
+            name='paidTotal',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='tab',
+            name='voidedTotal',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=15),
+        ),
+        migrations.RunPython(fill_tab_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0032_tab_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tab',
+            index=models.Index(fields=['state', 'closedAt'], name='posapp_tab_state_3a0ffb_idx'),
+        ),
+    ]
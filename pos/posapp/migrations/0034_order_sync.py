@@ -0,0 +1,30 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0033_tab_state_closedat_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tab',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='SyncedOrder',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('syncedAt', models.DateTimeField(auto_now_add=True)),
+                ('version', models.PositiveIntegerField()),
+                ('tab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='posapp.Tab')),
+                ('waiter', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:50
+
+from django.db import migrations, models
+
+TIMESTAMPS = ['orderedAt', 'preparingAt', 'preparedAt', 'servedAt', 'voidedAt']
+
+
+def collapse_orders(apps, schema_editor):
+    # Rows used to be created one per unit, each with its own timestamps a few microseconds apart. Units of the same
+    # product, note, price and state whose timestamps match to the second are merged into the first of them.
+    ProductInTab = apps.get_model('posapp', 'ProductInTab')
+    OrderVoidRequest = apps.get_model('posapp', 'OrderVoidRequest')
+    kept = {}
+    merged = {}
+    for order in ProductInTab.objects.order_by('tab', 'orderedAt', 'id').iterator():
+        key = (order.tab_id, order.product_id, order.note, order._price, order.state) + tuple(
+            value.replace(microsecond=0) if value else None for value in
+            (getattr(order, field) for field in TIMESTAMPS))
+        if key in kept:
+            kept[key].quantity += order.quantity
+            merged[order.id] = kept[key].id
+        else:
+            kept[key] = order
+
+    ProductInTab.objects.bulk_update([order for order in kept.values() if order.quantity > 1], ['quantity'],
+                                     batch_size=500)
+    for request in OrderVoidRequest.objects.filter(order_id__in=merged.keys()):
+        request.order_id = merged[request.order_id]
+        request.save(update_fields=['order'])
+    merged = list(merged.keys())
+    for start in range(0, len(merged), 500):
+        ProductInTab.objects.filter(id__in=merged[start:start + 500]).delete()
+
+
+def expand_orders(apps, schema_editor):
+    ProductInTab = apps.get_model('posapp', 'ProductInTab')
+    for order in ProductInTab.objects.filter(quantity__gt=1).iterator():
+        ProductInTab.objects.bulk_create([ProductInTab(
+            product_id=order.product_id, tab_id=order.tab_id, state=order.state, _price=order._price, quantity=1,
+            note=order.note, **{field: getattr(order, field) for field in TIMESTAMPS}
+        ) for _ in range(order.quantity - 1)])
+        order.quantity = 1
+        order.save(update_fields=['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0034_order_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordervoidrequest',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='productintab',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(collapse_orders, expand_orders),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:52
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+def create_tickets(apps, schema_editor):
+    # Orders of one tab placed within the same second are assumed to have been submitted together
+    Ticket = apps.get_model('posapp', 'Ticket')
+    ProductInTab = apps.get_model('posapp', 'ProductInTab')
+    tickets = {}
+    orders = {}
+    for order in ProductInTab.objects.filter(ticket__isnull=True).only('id', 'tab', 'orderedAt').iterator():
+        key = (order.tab_id, order.orderedAt.replace(microsecond=0))
+        if key not in tickets:
+            tickets[key] = Ticket(tab_id=order.tab_id, createdAt=order.orderedAt)
+        orders.setdefault(key, []).append(order.id)
+    Ticket.objects.bulk_create(tickets.values(), batch_size=500)
+    for key, ids in orders.items():
+        ProductInTab.objects.filter(id__in=ids).update(ticket=tickets[key])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0035_order_quantity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ticket',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('createdAt', models.DateTimeField(default=datetime.datetime.now, editable=False)),
+                ('tab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='posapp.Tab')),
+                ('waiter', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='productintab',
+            name='ticket',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='posapp.Ticket'),
+        ),
+        migrations.RunPython(create_tickets, migrations.RunPython.noop),
+    ]
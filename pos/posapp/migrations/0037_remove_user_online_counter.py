@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0036_ticket'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='online_counter',
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:23
+
+from decimal import Decimal
+from hashlib import sha256
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ledgers(apps, schema_editor):
+    # Counts paid to or edited before the ledger existed start with an opening entry holding their sums, digested
+    # like TillLedgerEntry.compute_digest does
+    TillMoneyCount = apps.get_model('posapp', 'TillMoneyCount')
+    TillLedgerEntry = apps.get_model('posapp', 'TillLedgerEntry')
+    for count in TillMoneyCount.objects.all():
+        paid = count.paymentintab_set.aggregate(sum=models.Sum('amount'))['sum']
+        edited = count.tilledit_set.aggregate(sum=models.Sum('amount'))['sum']
+        if paid is None and edited is None:
+            continue
+        paid, edited = paid or Decimal(0), edited or Decimal(0)
+        fields = ['', '1', 'O', *(f"{value:.3f}" for value in (Decimal(0), paid, edited)), '']
+        TillLedgerEntry.objects.create(count=count, sequence=1, kind='O', amount=0, paid=paid, edited=edited,
+                                       digest=sha256('|'.join(fields).encode()).hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0039_usernotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TillLedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('O', 'Opening balance'), ('P', 'Payment'), ('R', 'Payment removed'), ('E', 'Edit')], max_length=1)),
+                ('amount', models.DecimalField(decimal_places=3, max_digits=15)),
+                ('paid', models.DecimalField(decimal_places=3, max_digits=15)),
+                ('edited', models.DecimalField(decimal_places=3, max_digits=15)),
+                ('source', models.UUIDField(blank=True, null=True)),
+                ('createdAt', models.DateTimeField(auto_now_add=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('count', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='posapp.TillMoneyCount')),
+            ],
+            options={
+                'verbose_name_plural': 'Till ledger entries',
+            },
+        ),
+        migrations.CreateModel(
+            name='TillLedgerSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('paid', models.DecimalField(decimal_places=3, max_digits=15)),
+                ('edited', models.DecimalField(decimal_places=3, max_digits=15)),
+                ('digest', models.CharField(max_length=64)),
+                ('createdAt', models.DateTimeField(auto_now_add=True)),
+                ('count', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_snapshots', to='posapp.TillMoneyCount')),
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='posapp.TillLedgerEntry')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tillledgerentry',
+            index=models.Index(fields=['count', 'createdAt'], name='posapp_till_count_i_df885c_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='tillledgerentry',
+            constraint=models.UniqueConstraint(fields=('count', 'sequence'), name='posapp_tillledgerentry_sequence'),
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
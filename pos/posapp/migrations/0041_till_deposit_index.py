@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0040_till_ledger'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='till',
+            name='deposit',
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0041_till_deposit_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceConnection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('connection', models.CharField(max_length=128)),
+                ('expiresAt', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('username', 'connection')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0042_presenceconnection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamMetrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('connections', models.BigIntegerField(default=0)),
+                ('queued', models.BigIntegerField(default=0)),
+                ('coalesced', models.BigIntegerField(default=0)),
+                ('dropped', models.BigIntegerField(default=0)),
+                ('slow_closes', models.BigIntegerField(default=0)),
+                ('peak_queue', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'stream metrics',
+            },
+        ),
+    ]
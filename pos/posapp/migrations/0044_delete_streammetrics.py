@@ -0,0 +1,16 @@
+# Generated by Django 3.0.7 on 2026-10-18 06:04
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0043_streammetrics'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='StreamMetrics',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 06:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posapp', '0044_delete_streammetrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='claim',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+    ]
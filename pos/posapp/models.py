@@ -1,24 +1,35 @@
+import json
+import logging
 import mimetypes
 import os
 import re
 from datetime import datetime, date
-from hashlib import md5
+from decimal import Decimal
+from hashlib import md5, sha256
 from uuid import uuid4
 
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Concat
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 from django_fsm import FSMField, transition, ConcurrentTransitionMixin, has_transition_perm
 from django_fsm_log.decorators import fsm_log_by, fsm_log_description
 from phonenumber_field.modelfields import PhoneNumberField
 
 
+logger = logging.getLogger(__name__)
+
+
 # Create your models here.
 
 def action(group="state"):
@@ -33,6 +44,20 @@ def action(group="state"):
     return action_decorator
 
 
+class GroupConcat(models.Aggregate):
+    # Joins the values of a group with the separator, string_agg on PostgreSQL and group_concat on SQLite
+    function = "GROUP_CONCAT"
+    # The separator is written into the SQL, SQLite refuses aggregates with more than one argument expression
+    template = "%(function)s(%(expressions)s, '%(separator)s')"
+
+    def __init__(self, expression, separator, **extra):
+        super(GroupConcat, self).__init__(expression, separator=separator.replace("'", "''"),
+                                          output_field=models.TextField(), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="STRING_AGG", **extra_context)
+
+
 class HasActionsMixin:
     @classmethod
     def list_actions(cls, group="state"):
@@ -55,7 +80,6 @@ class User(AbstractUser):
     current_till = models.ForeignKey("Till", null=True, on_delete=models.SET_NULL)
     current_temp_tab = models.OneToOneField("Tab", null=True, on_delete=models.SET_NULL, related_name="temp_tab_owner")
     mobile_phone = PhoneNumberField()
-    online_counter = models.IntegerField(validators=[MinValueValidator(0)], default=0)
 
     @property
     def requires_director_to_toggle(self):
@@ -147,6 +171,112 @@ class ItemInProduct(models.Model):
         return f"{self.item} in {self.product}"
 
 
+class OutboxMessage(models.Model):
+    # Channel layer messages waiting to be sent. They are written in the transaction that caused them, so they go
+    # out only once it commits and are not lost if the channel layer is down, see posapp.outbox.
+    group = models.CharField(max_length=128)
+    payload = models.TextField()
+    createdAt = models.DateTimeField(auto_now_add=True, editable=False)
+    attempts = models.PositiveIntegerField(default=0)
+    nextAttemptAt = models.DateTimeField(default=timezone.now, db_index=True)
+    # The dispatcher sending the message, see posapp.outbox.claim
+    claim = models.UUIDField(null=True, editable=False)
+
+    @property
+    def message(self):
+        return json.loads(self.payload)
+
+    @staticmethod
+    def enqueue(group, message):
+        from posapp import outbox
+        OutboxMessage.objects.create(group=group, payload=json.dumps(message, cls=DjangoJSONEncoder))
+        transaction.on_commit(outbox.wake)
+
+    def __str__(self):
+        return f"{self.message['type']} to {self.group}"
+
+
+class UserNotification(models.Model):
+    # A user's inbox. Notifications stay here for NOTIFICATION_RETENTION_DAYS so a socket that was down when they
+    # were sent can replay them, the increasing id is the cursor it resumes from.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="notifications")
+    payload = models.TextField()
+    createdAt = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"]),
+        ]
+
+    @property
+    def notification(self):
+        return {**json.loads(self.payload), "sequence": self.id}
+
+    @staticmethod
+    def send(user, notification):
+        entry = UserNotification.objects.create(user=user, payload=json.dumps(notification, cls=DjangoJSONEncoder))
+        OutboxMessage.enqueue(f"notifications_user-{user.id}", {
+            "type": "notification.inbox",
+            "notification": entry.notification,
+        })
+        return entry
+
+
+class PresenceConnection(models.Model):
+    # An open websocket of a user, see posapp.presence.DatabasePresenceStore. Heartbeats push expiresAt forward.
+    username = models.CharField(max_length=150)
+    connection = models.CharField(max_length=128)
+    expiresAt = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [("username", "connection")]
+
+
+def publish_on_commit(description, send):
+    # Runs send once the transaction commits. The data is saved by then, so a channel layer failure is only logged:
+    # it must neither fail the request nor stop the commit hooks after it.
+    def publish():
+        try:
+            send()
+        except Exception:
+            logger.exception("Publishing %s failed", description)
+
+    transaction.on_commit(publish)
+
+
+def publish_order_update(notification_type, **update):
+    # Kitchen displays listen on the orders group. The update is sent only once the surrounding transaction commits,
+    # so a display never asks for orders it can't see yet. It is only a hint to refetch, so it skips the outbox and
+    # stays out of the bump and order queries.
+    channel_layer = get_channel_layer()
+    publish_on_commit(notification_type, lambda: async_to_sync(channel_layer.group_send)("orders", {
+        "type": "order.update",
+        "update": {
+            "notification_type": notification_type,
+            **update,
+        },
+    }))
+
+
+def publish_tab_state(tab_id, lines=(), ticket_id=None):
+    # Pages showing a tab listen on its group and get its totals plus the counts of the product lines that changed,
+    # given as (product id, note) pairs or as all lines of a ticket. Built once the transaction commits, so an update
+    # never shows uncommitted data and its version only grows. Like the kitchen hints it stays out of the outbox, so
+    # bumps remain a single query, and a failed send is only logged.
+    lines = set(lines)
+
+    def send():
+        changed = lines | set(ProductInTab.objects.filter(ticket_id=ticket_id).values_list("product", "note")) \
+            if ticket_id else lines
+        tab = Tab.objects.get(pk=tab_id)
+        async_to_sync(get_channel_layer().group_send)(Tab.group_name(tab_id), {
+            "type": "tab.update",
+            "update": tab.state_update(changed),
+        })
+
+    publish_on_commit(f"the state of tab {tab_id}", send)
+
+
 class Tab(models.Model):
     OPEN = 'O'
     PAID = 'P'
@@ -161,33 +291,112 @@ class Tab(models.Model):
     openedAt = models.DateTimeField(editable=False, auto_now_add=True)
     closedAt = models.DateTimeField(null=True, blank=True)
     owner = models.ForeignKey(User, on_delete=models.PROTECT, null=True)
+    orderedTotal = models.DecimalField(max_digits=15, decimal_places=3, default=0, editable=False)
+    voidedTotal = models.DecimalField(max_digits=15, decimal_places=3, default=0, editable=False)
+    paidTotal = models.DecimalField(max_digits=15, decimal_places=3, default=0, editable=False)
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    TOTAL_FIELDS = ["orderedTotal", "voidedTotal", "paidTotal"]
+    COUNTER_FIELDS = TOTAL_FIELDS + ["version"]
 
     class Meta:
         permissions = [
             ("order_product", "Can order a product")
         ]
+        indexes = [
+            models.Index(fields=["state", "closedAt"]),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Running totals and the version are only ever changed through update_totals/rebuild_totals, a stale
+        # instance must not overwrite them
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in Tab.COUNTER_FIELDS]
+        super(Tab, self).save(*args, **kwargs)
+
     @property
     def total(self):
-        sum = 0
-        for product in ProductInTab.objects.filter(tab=self):
-            sum += product.price
-        return sum
+        return self.orderedTotal - self.voidedTotal
 
     @property
     def paid(self):
-        sum = 0
-        for payment in self.payments.all():
-            sum += payment.converted_value
-        return sum
+        return float(self.paidTotal)
+
+    def update_totals(self, ordered=0, voided=0, paid=0):
+        Tab.objects.filter(pk=self.pk).update(
+            orderedTotal=F("orderedTotal") + ordered,
+            voidedTotal=F("voidedTotal") + voided,
+            paidTotal=F("paidTotal") + paid,
+            version=F("version") + 1,
+        )
+        self.refresh_from_db(fields=Tab.COUNTER_FIELDS)
+
+    def calculate_totals(self):
+        orders = ProductInTab.objects.filter(tab=self)
+        ordered = orders.aggregate(sum=ProductInTab.SUM_PRICE)["sum"] or Decimal(0)
+        voided = orders.filter(state=ProductInTab.VOIDED).aggregate(sum=ProductInTab.SUM_PRICE)["sum"] or Decimal(0)
+        paid = Decimal(0)
+        for payment in self.payments.select_related("method__paymentMethod__currency"):
+            paid += payment.converted_amount
+        return {"orderedTotal": ordered, "voidedTotal": voided, "paidTotal": paid}
+
+    def rebuild_totals(self):
+        totals = self.calculate_totals()
+        Tab.objects.filter(pk=self.pk).update(version=F("version") + 1, **totals)
+        self.refresh_from_db(fields=Tab.COUNTER_FIELDS)
 
     @property
     def variance(self):
         return round(float(self.total) - self.paid, 3)
 
+    @staticmethod
+    def group_name(tab_id):
+        return f"tab-{tab_id}"
+
+    # Counts of the tab's product lines by state, all lines or only the given (product id, note) pairs
+    def line_states(self, lines=None):
+        def empty_line():
+            return {"ordered": 0, "preparing": 0, "toServe": 0, "served": 0, "total": Decimal(0)}
+
+        orders = ProductInTab.objects.filter(tab=self)
+        states = {}
+        if lines is not None:
+            query = models.Q(pk__in=[])
+            # A missing note is the same line as an empty one
+            for product, note in lines:
+                notes = models.Q(note=note) if note else models.Q(note="") | models.Q(note__isnull=True)
+                query |= models.Q(product=product) & notes
+                states[(product, note or "")] = empty_line()
+            orders = orders.filter(query)
+        rows = orders.values("product", "note", "state") \
+            .annotate(count=models.Sum("quantity"), total=ProductInTab.SUM_PRICE) \
+            .order_by("product", "note")
+        for row in rows:
+            line = states.setdefault((row["product"], row["note"] or ""), empty_line())
+            if row["state"] in ProductInTab.LINE_STATE_KEYS:
+                line[ProductInTab.LINE_STATE_KEYS[row["state"]]] += row["count"]
+                line["total"] += row["total"]
+        return [{"product": str(product), "note": note, **line, "total": str(line["total"])}
+                for (product, note), line in states.items()]
+
+    # A compact JSON-ready state of the tab, the lines are limited like in line_states
+    def state_update(self, lines=None):
+        return {
+            "notification_type": "tab_state",
+            "tab": str(self.id),
+            "version": self.version,
+            "open": self.state == Tab.OPEN,
+            "total": str(self.total),
+            "paid": self.paid,
+            "variance": self.variance,
+            "payments": self.payments.count(),
+            "lines": self.line_states(lines),
+        }
+
     @property
     def transfer_request_exists(self):
         return self.tabtransferrequest_set.count() > 0
@@ -196,16 +405,30 @@ class Tab(models.Model):
     def is_temp(self):
         return self.temp_tab_owner
 
-    def order_product(self, product, count, note, state):
-        for i in range(count):
+    def order_product(self, product, count, note, state, waiter=None):
+        self.order_products([(product, count, note, state)], waiter)
+
+    @transaction.atomic
+    def order_products(self, lines, waiter=None):
+        time = datetime.now()
+        ticket = Ticket.objects.create(tab=self, waiter=waiter, createdAt=time)
+        new_orders = []
+        ordered = 0
+        for product, count, note, state in lines:
+            if not isinstance(count, int) or count < 1:
+                raise ValidationError(f"The amount of {product} must be a positive whole number")
+            if state not in ProductInTab.NEW_ORDER_STATES:
+                raise ValidationError(f"The state {state} is not valid for a new order")
+
             new = ProductInTab()
             new.product = product
             new.tab = self
+            new.ticket = ticket
             new.price = product.price
+            new.quantity = count
             new.note = note
             new.state = state
-
-            time = datetime.now()
+            new.orderedAt = time
 
             if state == ProductInTab.SERVED:
                 new.preparingAt = time
@@ -218,8 +441,18 @@ class Tab(models.Model):
                 new.preparingAt = time
 
             new.clean()
-            new.save()
-
+            new_orders.append(new)
+            ordered += product.price * count
+
+        ProductInTab.objects.bulk_create(new_orders)
+        if ordered:
+            self.update_totals(ordered=ordered)
+        publish_order_update("order_created", tab=str(self.id), ticket=str(ticket.id),
+                             orders=[str(order.id) for order in new_orders])
+        publish_tab_state(self.id, ticket_id=ticket.id)
+        return new_orders
+
+    @transaction.atomic
     def mark_paid(self, by: User):
         if hasattr(self, 'temp_tab_owner'):
             owner = self.temp_tab_owner
@@ -227,6 +460,8 @@ class Tab(models.Model):
             owner.clean()
             owner.save()
             self.refresh_from_db()
+        else:
+            self.refresh_from_db(fields=Tab.TOTAL_FIELDS)
         variance = self.variance
         change_payment = None
         if variance < 0:
@@ -241,6 +476,7 @@ class Tab(models.Model):
         self.closedAt = datetime.now()
         self.clean()
         self.save()
+        publish_tab_state(self.id)
         return change_payment
 
     def clean(self):
@@ -248,6 +484,51 @@ class Tab(models.Model):
             raise ValidationError("Tab cannot be saved as paid and have a temp tab owner")
 
 
+class Ticket(models.Model):
+    id = models.UUIDField(primary_key=True, null=False, editable=False, default=uuid4)
+    tab = models.ForeignKey(Tab, on_delete=models.CASCADE)
+    waiter = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True)
+    createdAt = models.DateTimeField(editable=False, default=datetime.now)
+
+    def __str__(self):
+        return f"Ticket of {self.tab} at {self.createdAt}"
+
+    def bump(self, state=None):
+        # Moves every unit of the ticket (or only those in the given state) one state forward in a single UPDATE.
+        # The timestamps are listed before the state, as MySQL evaluates the assignments left to right.
+        orders = self.productintab_set.filter(
+            state__in=[ProductInTab.ORDERED, ProductInTab.PREPARING, ProductInTab.TO_SERVE])
+        if state:
+            orders = orders.filter(state=state)
+        time = Value(datetime.utcnow(), output_field=models.DateTimeField())
+        count = orders.update(
+            preparingAt=Case(When(state=ProductInTab.ORDERED, then=time), default=F("preparingAt")),
+            preparedAt=Case(When(state=ProductInTab.PREPARING, then=time), default=F("preparedAt")),
+            servedAt=Case(When(state=ProductInTab.TO_SERVE, then=time), default=F("servedAt")),
+            state=Case(When(state=ProductInTab.ORDERED, then=Value(ProductInTab.PREPARING)),
+                       When(state=ProductInTab.PREPARING, then=Value(ProductInTab.TO_SERVE)),
+                       default=Value(ProductInTab.SERVED), output_field=models.CharField()),
+        )
+        if count:
+            self.publish_state_change()
+        return count
+
+    @transaction.atomic
+    def void(self):
+        orders = self.productintab_set.select_for_update().exclude(state=ProductInTab.VOIDED)
+        voided = orders.aggregate(sum=ProductInTab.SUM_PRICE)["sum"]
+        count = orders.update(state=ProductInTab.VOIDED, voidedAt=datetime.utcnow())
+        if voided:
+            self.tab.update_totals(voided=voided)
+        if count:
+            self.publish_state_change()
+        return count
+
+    def publish_state_change(self):
+        publish_order_update("order_state_changed", tab=str(self.tab_id), ticket=str(self.id))
+        publish_tab_state(self.tab_id, ticket_id=self.id)
+
+
 class ProductInTab(models.Model):
     ORDERED = 'O'
     PREPARING = 'P'
@@ -261,11 +542,20 @@ class ProductInTab(models.Model):
         (SERVED, "Served"),
         (VOIDED, "Voided"),
     ]
+    NEW_ORDER_STATES = [ORDERED, PREPARING, TO_SERVE, SERVED]
+    LINE_STATE_KEYS = {
+        ORDERED: "ordered",
+        PREPARING: "preparing",
+        TO_SERVE: "toServe",
+        SERVED: "served",
+    }
     id = models.UUIDField(primary_key=True, null=False, editable=False, default=uuid4)
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     tab = models.ForeignKey(Tab, on_delete=models.CASCADE)
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, null=True, blank=True)
     state = models.CharField(max_length=1, choices=SERVING_STATES, default=ORDERED)
     _price = models.DecimalField(max_digits=15, decimal_places=3, db_column="price")
+    quantity = models.PositiveIntegerField(default=1)
     orderedAt = models.DateTimeField(editable=False, default=datetime.now)
     preparingAt = models.DateTimeField(null=True, blank=True)
     preparedAt = models.DateTimeField(null=True, blank=True)
@@ -273,6 +563,10 @@ class ProductInTab(models.Model):
     voidedAt = models.DateTimeField(null=True, blank=True)
     note = models.TextField(null=True, blank=True)
 
+    # _price is the price of a single unit
+    SUM_PRICE = models.Sum(F("_price") * F("quantity"), output_field=models.DecimalField(max_digits=15,
+                                                                                         decimal_places=3))
+
     class Meta:
         verbose_name_plural = "Products in tabs"
 
@@ -284,7 +578,31 @@ class ProductInTab(models.Model):
     def price(self, value):
         self._price = value
 
-    def bump(self):
+    @property
+    def total(self):
+        return self.price * self.quantity
+
+    def split(self, quantity):
+        # Leaves this row with the given quantity and moves the rest into a new row in the current state, so that
+        # only part of the order can change state
+        if quantity is None or quantity == self.quantity:
+            return
+        if not isinstance(quantity, int) or not 0 < quantity < self.quantity:
+            raise ValidationError(f"The quantity must be between 1 and {self.quantity}")
+        rest = ProductInTab(product_id=self.product_id, tab_id=self.tab_id, ticket_id=self.ticket_id,
+                            state=self.state, _price=self._price, quantity=self.quantity - quantity,
+                            orderedAt=self.orderedAt, preparingAt=self.preparingAt, preparedAt=self.preparedAt,
+                            servedAt=self.servedAt, voidedAt=self.voidedAt, note=self.note)
+        rest.clean()
+        rest.save()
+        self.quantity = quantity
+        self.save(update_fields=["quantity"])
+
+    @transaction.atomic
+    def bump(self, quantity=None):
+        if self.state not in [ProductInTab.ORDERED, ProductInTab.PREPARING, ProductInTab.TO_SERVE]:
+            return False
+        self.split(quantity)
         if self.state == ProductInTab.ORDERED:
             self.state = ProductInTab.PREPARING
             self.preparingAt = datetime.utcnow()
@@ -294,12 +612,17 @@ class ProductInTab(models.Model):
         elif self.state == ProductInTab.TO_SERVE:
             self.state = ProductInTab.SERVED
             self.servedAt = datetime.utcnow()
-        else:
-            return False
         self.clean()
         self.save()
+        self.publish_state_change()
         return True
 
+    def publish_state_change(self):
+        publish_order_update("order_state_changed", tab=str(self.tab_id),
+                             ticket=str(self.ticket_id) if self.ticket_id else None, orders=[str(self.id)],
+                             state=self.state)
+        publish_tab_state(self.tab_id, [(self.product_id, self.note)])
+
     @property
     def color(self):
         if self.state == ProductInTab.ORDERED:
@@ -317,12 +640,19 @@ class ProductInTab(models.Model):
     def count_price(self):
         return self.state not in [ProductInTab.VOIDED, ]
 
-    def void(self):
+    @transaction.atomic
+    def void(self, quantity=None):
+        # Re-read under a lock, voiding a stale instance or the same row twice at once must not count it twice
+        ProductInTab.objects.select_for_update().filter(pk=self.pk).first()
+        self.refresh_from_db()
         if self.state != ProductInTab.VOIDED:
+            self.split(quantity)
             self.state = ProductInTab.VOIDED
             self.voidedAt = datetime.utcnow()
             self.clean()
             self.save()
+            self.tab.update_totals(voided=self._price * self.quantity)
+            self.publish_state_change()
 
     def clean(self):
         def raise_over(state):
@@ -416,7 +746,9 @@ class Deposit(models.Model):
     class Meta:
         verbose_name_plural = "Till payment options"
 
-    def create_till(self):
+    @transaction.atomic
+    def create_till(self, cashiers=()):
+        # The till, its money counts and its cashiers are saved together or not at all
         if self.enabled:
             till = Till()
             till.changeMethod = self.changeMethod
@@ -424,12 +756,15 @@ class Deposit(models.Model):
             till.deposit = self.name
             till.clean()
             till.save()
+            counts = []
             for method in self.methods.all():
                 count = TillMoneyCount()
                 count.till = till
                 count.paymentMethod = method
                 count.clean()
-                count.save()
+                counts.append(count)
+            TillMoneyCount.objects.bulk_create(counts)
+            till.assign_cashiers(cashiers)
             return till
         else:
             return None
@@ -471,20 +806,43 @@ class Till(models.Model):
     paymentMethods = models.ManyToManyField(PaymentMethod, through="TillMoneyCount", related_name="tillsEnabled")
     changeMethod = models.ForeignKey(PaymentMethod, on_delete=models.PROTECT, related_name="tillsAsChange")
     depositAmount = models.DecimalField(max_digits=15, decimal_places=3)
-    deposit = models.CharField(max_length=1024)
+    deposit = models.CharField(max_length=1024, db_index=True)
+
+    # Separates the names with_cashier_names aggregates, no name contains it
+    NAME_SEPARATOR = "\x1f"
+
+    @staticmethod
+    def with_cashier_names(tills=None):
+        # Tills with their cashiers' names aggregated in the query, cashier_names reads them instead of querying
+        tills = Till.objects.all() if tills is None else tills
+        return tills.annotate(cashier_list=GroupConcat(
+            Concat("cashiers__first_name", Value(" "), "cashiers__last_name"), Till.NAME_SEPARATOR,
+            # A till without cashiers joins one empty row, which would concatenate to " "
+            filter=models.Q(cashiers__isnull=False),
+        ))
 
     @property
     def cashier_names(self):
-        if self.cashiers:
-            namelist = [cashier.name for cashier in self.cashiers.all()]
-            names = namelist[0]
-            if len(namelist) > 1:
-                for name in namelist[1:-1]:
-                    names += f", {name}"
-                names += f" and {namelist[-1]}"
-            return names
+        if hasattr(self, "cashier_list"):
+            namelist = sorted(self.cashier_list.split(Till.NAME_SEPARATOR)) if self.cashier_list else []
         else:
+            namelist = sorted(cashier.name for cashier in self.cashiers.all())
+        if not namelist:
             return "Nobody is assigned"
+        names = namelist[0]
+        if len(namelist) > 1:
+            for name in namelist[1:-1]:
+                names += f", {name}"
+            names += f" and {namelist[-1]}"
+        return names
+
+    def assign_cashiers(self, cashiers):
+        # One update and one insert however many cashiers there are
+        for cashier in cashiers:
+            cashier.current_till = self
+        User.objects.filter(pk__in=[cashier.pk for cashier in cashiers]).update(current_till=self)
+        Till.cashiers.through.objects.bulk_create([Till.cashiers.through(till=self, user=cashier)
+                                                   for cashier in cashiers])
 
     def stop(self):
         if self.state == Till.OPEN:
@@ -492,10 +850,7 @@ class Till(models.Model):
             self.stoppedAt = datetime.now()
             self.clean()
             self.save()
-            for cashier in self.cashiers.all():
-                cashier.current_till = None
-                cashier.clean()
-                cashier.save()
+            User.objects.filter(current_till=self).update(current_till=None)
             return True
         else:
             return False
@@ -521,20 +876,22 @@ class TillMoneyCount(models.Model):
     till = models.ForeignKey(Till, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=15, decimal_places=3, default=0)
 
+    # The last ledger entry at the given time or now, None if nothing was paid or edited yet
+    def balance(self, at=None):
+        entries = self.ledger.all()
+        if at is not None:
+            entries = entries.filter(createdAt__lte=at)
+        return entries.order_by("-sequence").first()
+
     @property
     def expected(self):
-        val = 0
-        payments = self.paymentintab_set.all()
-        for payment in payments:
-            val += payment.amount
-        return val
+        balance = self.balance()
+        return balance.paid if balance else Decimal(0)
 
     @property
     def counted(self):
-        counted = self.amount
-        for edit in self.tilledit_set.all():
-            counted += edit.amount
-        return counted
+        balance = self.balance()
+        return self.amount + (balance.edited if balance else Decimal(0))
 
     def add_edit(self, amount, reason):
         counted = self.counted
@@ -561,6 +918,102 @@ class TillEdit(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     reason = models.TextField()
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super(TillEdit, self).save(*args, **kwargs)
+        if adding:
+            TillLedgerEntry.append(self.count_id, TillLedgerEntry.EDIT, self.amount, self.id)
+
+
+class TillLedgerEntry(models.Model):
+    # Append-only history of a count's money. Every payment, removed payment and edit adds an entry carrying the sums
+    # after it, so the balance now or at any past moment is one row. The digest of an entry covers the previous one,
+    # rewriting history breaks the chain, see tills.verify_ledger.
+    OPENING = 'O'
+    PAYMENT = 'P'
+    PAYMENT_REMOVED = 'R'
+    EDIT = 'E'
+    KINDS = [
+        (OPENING, "Opening balance"),
+        (PAYMENT, "Payment"),
+        (PAYMENT_REMOVED, "Payment removed"),
+        (EDIT, "Edit"),
+    ]
+    count = models.ForeignKey(TillMoneyCount, on_delete=models.CASCADE, related_name="ledger")
+    sequence = models.PositiveIntegerField()
+    kind = models.CharField(max_length=1, choices=KINDS)
+    amount = models.DecimalField(max_digits=15, decimal_places=3)
+    # Sums of the count's payments and edits including this entry
+    paid = models.DecimalField(max_digits=15, decimal_places=3)
+    edited = models.DecimalField(max_digits=15, decimal_places=3)
+    # The payment or edit the entry records
+    source = models.UUIDField(null=True, blank=True)
+    createdAt = models.DateTimeField(auto_now_add=True, editable=False)
+    digest = models.CharField(max_length=64)
+
+    class Meta:
+        verbose_name_plural = "Till ledger entries"
+        constraints = [
+            models.UniqueConstraint(fields=["count", "sequence"], name="posapp_tillledgerentry_sequence"),
+        ]
+        indexes = [
+            models.Index(fields=["count", "createdAt"]),
+        ]
+
+    @staticmethod
+    def compute_digest(previous, sequence, kind, amount, paid, edited, source):
+        fields = [previous, str(sequence), kind, *(f"{value:.3f}" for value in (amount, paid, edited)),
+                  str(source or "")]
+        return sha256("|".join(fields).encode()).hexdigest()
+
+    @staticmethod
+    @transaction.atomic
+    def append(count_id, kind, amount, source=None):
+        # Appends to one count are serialized by locking its row
+        TillMoneyCount.objects.select_for_update().filter(pk=count_id).first()
+        last = TillLedgerEntry.objects.filter(count_id=count_id).order_by("-sequence").first()
+        amount = Decimal(str(amount)).quantize(Decimal("0.001"))
+        sequence = last.sequence + 1 if last else 1
+        paid = last.paid if last else Decimal(0)
+        edited = last.edited if last else Decimal(0)
+        if kind == TillLedgerEntry.EDIT:
+            edited += amount
+        else:
+            paid += amount
+
+        entry = TillLedgerEntry.objects.create(
+            count_id=count_id, sequence=sequence, kind=kind, amount=amount, paid=paid, edited=edited, source=source,
+            digest=TillLedgerEntry.compute_digest(last.digest if last else "", sequence, kind, amount, paid, edited,
+                                                  source),
+        )
+        if sequence % settings.TILL_LEDGER_SNAPSHOT_INTERVAL == 0:
+            TillLedgerSnapshot.objects.create(count_id=count_id, entry=entry, paid=paid, edited=edited,
+                                              digest=entry.digest)
+        return entry
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("Till ledger entries can't be changed")
+        super(TillLedgerEntry, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError("Till ledger entries can't be deleted")
+
+    def __str__(self):
+        return f"{self.get_kind_display()} of {self.amount} in {self.count}"
+
+
+class TillLedgerSnapshot(models.Model):
+    # The sums and digest of a count's ledger every TILL_LEDGER_SNAPSHOT_INTERVAL entries. Checkpoints verifying the
+    # chain can start from instead of the first entry.
+    count = models.ForeignKey(TillMoneyCount, on_delete=models.CASCADE, related_name="ledger_snapshots")
+    entry = models.OneToOneField(TillLedgerEntry, on_delete=models.CASCADE, related_name="snapshot")
+    paid = models.DecimalField(max_digits=15, decimal_places=3)
+    edited = models.DecimalField(max_digits=15, decimal_places=3)
+    digest = models.CharField(max_length=64)
+    createdAt = models.DateTimeField(auto_now_add=True, editable=False)
+
 
 class PaymentInTab(models.Model):
     id = models.UUIDField(primary_key=True, null=False, editable=False, default=uuid4)
@@ -572,6 +1025,37 @@ class PaymentInTab(models.Model):
     def converted_value(self):
         return round(float(self.amount) * self.method.paymentMethod.currency.ratio, 3)
 
+    @property
+    def converted_amount(self):
+        return Decimal(str(self.converted_value))
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            old = None
+            delta = self.converted_amount
+        else:
+            old = PaymentInTab.objects.get(pk=self.pk)
+            delta = self.converted_amount - old.converted_amount
+        super(PaymentInTab, self).save(*args, **kwargs)
+        if delta:
+            self.tab.update_totals(paid=delta)
+        if old is None:
+            TillLedgerEntry.append(self.method_id, TillLedgerEntry.PAYMENT, self.amount, self.id)
+        elif old.method_id != self.method_id or old.amount != Decimal(str(self.amount)):
+            TillLedgerEntry.append(old.method_id, TillLedgerEntry.PAYMENT_REMOVED, -old.amount, self.id)
+            TillLedgerEntry.append(self.method_id, TillLedgerEntry.PAYMENT, self.amount, self.id)
+        publish_tab_state(self.tab_id)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        delta = self.converted_amount
+        TillLedgerEntry.append(self.method_id, TillLedgerEntry.PAYMENT_REMOVED, -Decimal(str(self.amount)), self.id)
+        result = super(PaymentInTab, self).delete(*args, **kwargs)
+        self.tab.update_totals(paid=-delta)
+        publish_tab_state(self.tab_id)
+        return result
+
     def clean(self):
         super(PaymentInTab, self).clean()
 
@@ -580,6 +1064,14 @@ class PaymentInTab(models.Model):
                                   f"it is currently disabled.")
 
 
+class SyncedOrder(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    tab = models.ForeignKey(Tab, on_delete=models.CASCADE)
+    waiter = models.ForeignKey(User, on_delete=models.PROTECT)
+    syncedAt = models.DateTimeField(auto_now_add=True, editable=False)
+    version = models.PositiveIntegerField()
+
+
 class OrderVoidRequest(models.Model):
     APPROVED = 'A'
     REJECTED = 'R'
@@ -590,12 +1082,14 @@ class OrderVoidRequest(models.Model):
 
     id = models.UUIDField(primary_key=True, null=False, editable=False, default=uuid4)
     order = models.ForeignKey(ProductInTab, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
     waiter = models.ForeignKey(User, on_delete=models.PROTECT, related_name='voids_requested')
     manager = models.ForeignKey(User, on_delete=models.PROTECT, related_name='voids_approved', null=True)
     requestedAt = models.DateTimeField(auto_now_add=True, editable=False)
     resolvedAt = models.DateTimeField(null=True)
     resolution = models.CharField(max_length=1, choices=RESOLUTIONS, blank=True, null=True)
 
+    @transaction.atomic
     def approve(self, manager):
         if not self.resolution:
             self.resolution = OrderVoidRequest.APPROVED
@@ -603,12 +1097,13 @@ class OrderVoidRequest(models.Model):
             self.resolvedAt = datetime.now()
             self.clean()
             self.save()
-            self.order.void()
+            self.order.void(min(self.quantity, self.order.quantity))
             self.notify_waiter()
             return True
         else:
             return False
 
+    @transaction.atomic
     def reject(self, manager):
         if not self.resolution:
             self.resolution = OrderVoidRequest.REJECTED
@@ -622,37 +1117,30 @@ class OrderVoidRequest(models.Model):
             return False
 
     def notify_waiter(self):
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"notifications_user-{self.waiter.id}",
-            {
-                "type": "notification.void_request_resolved",
-                "void_request": {
-                    "notification_type": "void_request_resolved",
-                    "request_id": str(self.id),
-                    "manager": {
-                        "first_name": self.manager.first_name,
-                        "last_name": self.manager.last_name,
-                        "username": self.manager.username,
-                    },
-                    "order": {
-                        "id": str(self.order.id),
-                        "product_name": self.order.product.name,
-                        "state": self.order.state,
-                        "ordered_at": str(self.order.orderedAt),
-                        "preparing_at": str(self.order.preparingAt),
-                        "prepared_at": str(self.order.preparedAt),
-                        "served_at": str(self.order.servedAt),
-                        "note": self.order.note,
-                        "tab_name": self.order.tab.name,
-                        "tab_id": str(self.order.tab.id),
-                        "review_url": reverse("waiter/direct/order") if hasattr(self.order.tab, "temp_tab_owner") else
-                        reverse("waiter/tabs/tab", kwargs={"id": self.order.tab.id}),
-                    },
-                    "resolution": self.resolution,
-                },
+        UserNotification.send(self.waiter, {
+            "notification_type": "void_request_resolved",
+            "request_id": str(self.id),
+            "manager": {
+                "first_name": self.manager.first_name,
+                "last_name": self.manager.last_name,
+                "username": self.manager.username,
             },
-        )
+            "order": {
+                "id": str(self.order.id),
+                "product_name": self.order.product.name,
+                "state": self.order.state,
+                "ordered_at": str(self.order.orderedAt),
+                "preparing_at": str(self.order.preparingAt),
+                "prepared_at": str(self.order.preparedAt),
+                "served_at": str(self.order.servedAt),
+                "note": self.order.note,
+                "tab_name": self.order.tab.name,
+                "tab_id": str(self.order.tab.id),
+                "review_url": reverse("waiter/direct/order") if hasattr(self.order.tab, "temp_tab_owner") else
+                reverse("waiter/tabs/tab", kwargs={"id": self.order.tab.id}),
+            },
+            "resolution": self.resolution,
+        })
 
     def clean(self):
         super(OrderVoidRequest, self).clean()
@@ -661,6 +1149,8 @@ class OrderVoidRequest(models.Model):
             raise ValidationError("It appears there already is another unresolved request associated with this order.")
         if self.order.state == ProductInTab.VOIDED:
             raise ValidationError("The order is already voided.")
+        if not 0 < self.quantity <= self.order.quantity:
+            raise ValidationError(f"The quantity to void must be between 1 and {self.order.quantity}.")
 
         if bool(self.resolution) != bool(self.resolvedAt):
             raise ValidationError("Resolution and resolution timestamp must either be both set or both None.")
@@ -673,6 +1163,7 @@ class TabTransferRequest(models.Model):
     new_owner = models.ForeignKey(User, on_delete=models.PROTECT, related_name="tab_transfers_gaining")
     requestedAt = models.DateTimeField(auto_now_add=True, editable=False)
 
+    @transaction.atomic
     def approve(self, manager):
         old_owner = self.tab.owner
         self.tab.owner = self.new_owner
@@ -681,13 +1172,13 @@ class TabTransferRequest(models.Model):
         self.notify_waiter(manager, old_owner)
         self.delete()
 
+    @transaction.atomic
     def reject(self, manager):
         self.notify_waiter(manager)
         self.delete()
 
     def notify_waiter(self, manager, old_owner=False):
         is_claim = self.requester == self.new_owner
-        channel_layer = get_channel_layer()
         if old_owner != False:
             if is_claim:
                 message_old = f"{self.requester}'s claim request on tab {self.tab.name} was approved by {manager.name}."
@@ -699,22 +1190,16 @@ class TabTransferRequest(models.Model):
                               f"{manager.name}"
 
             if old_owner:
-                async_to_sync(channel_layer.group_send)(
-                    f"notifications_user-{old_owner.id}",
-                    {
-                        "type": "notification.tab_transfer_request_resolved",
-                        "message": message_old,
-                        "resolution": True,
-                    },
-                )
-            async_to_sync(channel_layer.group_send)(
-                f"notifications_user-{self.new_owner.id}",
-                {
-                    "type": "notification.tab_transfer_request_resolved",
-                    "message": message_new,
+                UserNotification.send(old_owner, {
+                    "notification_type": "tab_transfer_request_resolved",
+                    "message": message_old,
                     "resolution": True,
-                },
-            )
+                })
+            UserNotification.send(self.new_owner, {
+                "notification_type": "tab_transfer_request_resolved",
+                "message": message_new,
+                "resolution": True,
+            })
         else:
             if is_claim:
                 message = f"Your claim request on tab {self.tab.name} was rejected by {manager.name}."
@@ -722,14 +1207,11 @@ class TabTransferRequest(models.Model):
                 message = f"Your request to transfer tab {self.tab.name} to {self.new_owner.name} was rejected by" \
                           f"{manager.name}."
 
-            async_to_sync(channel_layer.group_send)(
-                f"notifications_user-{self.requester.id}",
-                {
-                    "type": "notification.tab_transfer_request_resolved",
-                    "message": message,
-                    "resolution": False,
-                },
-            )
+            UserNotification.send(self.requester, {
+                "notification_type": "tab_transfer_request_resolved",
+                "message": message,
+                "resolution": False,
+            })
 
     @property
     def is_transfer(self):
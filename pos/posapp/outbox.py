@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+
+from posapp.models import OutboxMessage
+
+# Sends the messages OutboxMessage.enqueue wrote. Each web process runs a dispatcher thread woken whenever a
+# transaction with messages commits, the dispatch_outbox command does the same from outside. A failed send is retried
+# with a growing delay, messages that keep failing stay in the table for inspection.
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 10
+MAX_RETRY_DELAY = 5 * 60
+# Dispatchers claim a batch with a conditional UPDATE, which works on SQLite too where rows can't be locked. A batch
+# whose dispatcher died is claimed again after CLAIM_TIMEOUT.
+CLAIM_TIMEOUT = timedelta(minutes=1)
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(2 ** attempts, MAX_RETRY_DELAY))
+
+
+def pending():
+    return OutboxMessage.objects.filter(attempts__lt=MAX_ATTEMPTS, nextAttemptAt__lte=timezone.now())
+
+
+async def send_all(messages):
+    # Messages to the same group keep their order, different groups are sent to concurrently
+    channel_layer = get_channel_layer()
+    groups = {}
+    for message in messages:
+        groups.setdefault(message.group, []).append(message)
+
+    async def send_group(group_messages):
+        results = []
+        for message in group_messages:
+            try:
+                await channel_layer.group_send(message.group, message.message)
+                results.append((message, None))
+            except Exception as err:
+                results.append((message, err))
+        return results
+
+    return [result for results in await asyncio.gather(*map(send_group, groups.values())) for result in results]
+
+
+# Returns the due messages this dispatcher got, the rows another one claimed in the meantime are left to it
+def claim(batch_size=BATCH_SIZE):
+    now = timezone.now()
+    ids = list(pending().order_by("id").values_list("id", flat=True)[:batch_size])
+    token = uuid.uuid4()
+    # Only rows still due are taken, a concurrent claim has pushed nextAttemptAt of its rows past now
+    pending().filter(id__in=ids).update(claim=token, nextAttemptAt=now + CLAIM_TIMEOUT)
+    return list(OutboxMessage.objects.filter(claim=token).order_by("id"))
+
+
+# Sends one batch, returns how many messages were sent and how many failed
+def dispatch(batch_size=BATCH_SIZE):
+    messages = claim(batch_size)
+    if not messages:
+        return 0, 0
+    results = async_to_sync(send_all)(messages)
+    sent = [message.id for message, err in results if err is None]
+    failed = [message for message, err in results if err is not None]
+    with transaction.atomic():
+        OutboxMessage.objects.filter(id__in=sent).delete()
+        now = timezone.now()
+        for message in failed:
+            message.attempts += 1
+            message.nextAttemptAt = now + retry_delay(message.attempts)
+            message.claim = None
+        OutboxMessage.objects.bulk_update(failed, ["attempts", "nextAttemptAt", "claim"])
+    return len(sent), len(failed)
+
+
+# Sends batches until nothing is due, returns whether any message is waiting for a retry
+def dispatch_pending(batch_size=BATCH_SIZE):
+    while True:
+        sent, failed = dispatch(batch_size)
+        if sent + failed < batch_size:
+            return OutboxMessage.objects.filter(attempts__lt=MAX_ATTEMPTS).exists()
+
+
+_wakeup = threading.Event()
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def run_dispatcher():
+    retry = True
+    while True:
+        _wakeup.wait(timeout=settings.OUTBOX_RETRY_INTERVAL if retry else None)
+        _wakeup.clear()
+        try:
+            retry = dispatch_pending()
+        except Exception:
+            logger.exception("Dispatching the notification outbox failed")
+            retry = True
+        finally:
+            close_old_connections()
+
+
+def wake():
+    global _dispatcher
+    if not settings.OUTBOX_DISPATCH_IN_PROCESS:
+        return
+    with _dispatcher_lock:
+        if _dispatcher is None or not _dispatcher.is_alive():
+            _dispatcher = threading.Thread(target=run_dispatcher, name="outbox-dispatcher", daemon=True)
+            _dispatcher.start()
+    _wakeup.set()
@@ -0,0 +1,26 @@
+import base64
+import datetime
+import uuid
+
+from django.db.models import F, Q
+
+
+def encode_cursor(obj, field):
+    value = getattr(obj, field)
+    value = f"{value.isoformat() if value is not None else ''}_{obj.pk}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+# Orders the queryset newest first by (field, pk) and keeps only the rows after the cursor. Rows without a value
+# come last, ordered by pk alone. A malformed cursor raises ValueError.
+def apply_cursor(queryset, field, cursor=""):
+    queryset = queryset.order_by(F(field).desc(nulls_last=True), "-pk")
+    if cursor:
+        value, pk = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("_", 1)
+        pk = uuid.UUID(pk)
+        if not value:
+            return queryset.filter(**{f"{field}__isnull": True, "pk__lt": pk})
+        value = datetime.datetime.fromisoformat(value)
+        queryset = queryset.filter(Q(**{f"{field}__lt": value}) | Q(**{field: value, "pk__lt": pk}) |
+                                   Q(**{f"{field}__isnull": True}))
+    return queryset
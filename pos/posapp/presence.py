@@ -0,0 +1,235 @@
+import asyncio
+import threading
+import time
+import weakref
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from posapp.models import PresenceConnection
+
+# Every open socket is a connection with an expiry time. Sockets renew it with heartbeats, so a connection whose
+# worker died simply runs out instead of leaving a counter stuck forever.
+
+
+class PresenceStore:
+    # Returns whether the connection was not counted before, i.e. whether the user's count changed
+    def touch(self, username, connection, ttl=None):
+        raise NotImplementedError
+
+    def remove(self, username, connection):
+        raise NotImplementedError
+
+    def counts(self, usernames):
+        raise NotImplementedError
+
+    # Drops expired connections and returns the new counts of the users that lost any
+    def reap(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def ttl(ttl=None):
+        return ttl or settings.PRESENCE_TTL
+
+
+class MemoryPresenceStore(PresenceStore):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def touch(self, username, connection, ttl=None):
+        now = time.time()
+        with self.lock:
+            connections = self.connections.setdefault(username, {})
+            new = connections.get(connection, 0) <= now
+            connections[connection] = now + self.ttl(ttl)
+        return new
+
+    def remove(self, username, connection):
+        with self.lock:
+            self.connections.get(username, {}).pop(connection, None)
+
+    def counts(self, usernames):
+        now = time.time()
+        with self.lock:
+            return {username: sum(1 for expires in self.connections.get(username, {}).values() if expires > now)
+                    for username in usernames}
+
+    def reap(self):
+        now = time.time()
+        changed = {}
+        with self.lock:
+            for username, connections in list(self.connections.items()):
+                alive = {connection: expires for connection, expires in connections.items() if expires > now}
+                if len(alive) != len(connections):
+                    changed[username] = len(alive)
+                if alive:
+                    self.connections[username] = alive
+                else:
+                    del self.connections[username]
+        return changed
+
+
+class CachePresenceStore(PresenceStore):
+    # Each user's connections live under one cache key, a set of all such users lets the reaper find them. The
+    # read-modify-write is not atomic: a lost heartbeat is repeated by the next one and a lost removal expires, so
+    # races heal within one TTL.
+    USERS_KEY = "posapp_presence-users"
+
+    @staticmethod
+    def user_key(username):
+        return f"posapp_presence-user-{username}"
+
+    def touch(self, username, connection, ttl=None):
+        ttl = self.ttl(ttl)
+        now = time.time()
+        connections = cache.get(self.user_key(username)) or {}
+        new = connections.get(connection, 0) <= now
+        connections[connection] = now + ttl
+        cache.set(self.user_key(username), connections, ttl * 2)
+        users = cache.get(self.USERS_KEY) or set()
+        if username not in users:
+            cache.set(self.USERS_KEY, users | {username}, None)
+        return new
+
+    def remove(self, username, connection):
+        connections = cache.get(self.user_key(username)) or {}
+        if connections.pop(connection, None):
+            cache.set(self.user_key(username), connections, self.ttl() * 2)
+
+    def counts(self, usernames):
+        now = time.time()
+        keys = {self.user_key(username): username for username in usernames}
+        cached = cache.get_many(keys.keys())
+        counts = {username: 0 for username in usernames}
+        for key, connections in cached.items():
+            counts[keys[key]] = sum(1 for expires in connections.values() if expires > now)
+        return counts
+
+    def reap(self):
+        now = time.time()
+        users = cache.get(self.USERS_KEY) or set()
+        cached = cache.get_many([self.user_key(username) for username in users])
+        changed = {}
+        remaining = set()
+        for username in users:
+            connections = cached.get(self.user_key(username))
+            if connections is None:
+                # Expired from the cache before the reaper got to it
+                changed[username] = 0
+                continue
+            alive = {connection: expires for connection, expires in connections.items() if expires > now}
+            if len(alive) != len(connections):
+                changed[username] = len(alive)
+                if alive:
+                    cache.set(self.user_key(username), alive, self.ttl() * 2)
+                else:
+                    cache.delete(self.user_key(username))
+            if alive:
+                remaining.add(username)
+        if remaining != users:
+            cache.set(self.USERS_KEY, remaining, None)
+        return changed
+
+
+class DatabasePresenceStore(PresenceStore):
+    # One row per connection, shared by every web, socket and reaper process. A heartbeat of a live connection is a
+    # single UPDATE, still a write per connect and heartbeat, so it is only for setups without a shared cache.
+    def touch(self, username, connection, ttl=None):
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.ttl(ttl))
+        connections = PresenceConnection.objects.filter(username=username, connection=connection)
+        if connections.filter(expiresAt__gt=now).update(expiresAt=expires):
+            return False
+        PresenceConnection.objects.update_or_create(username=username, connection=connection,
+                                                    defaults={"expiresAt": expires})
+        return True
+
+    def remove(self, username, connection):
+        PresenceConnection.objects.filter(username=username, connection=connection).delete()
+
+    def counts(self, usernames):
+        counts = {username: 0 for username in usernames}
+        rows = PresenceConnection.objects.filter(username__in=counts.keys(), expiresAt__gt=timezone.now()) \
+            .values("username").annotate(count=Count("id")).order_by()
+        counts.update({row["username"]: row["count"] for row in rows})
+        return counts
+
+    def reap(self):
+        expired = PresenceConnection.objects.filter(expiresAt__lte=timezone.now())
+        with transaction.atomic():
+            usernames = set(expired.values_list("username", flat=True))
+            expired.delete()
+        return self.counts(usernames)
+
+
+@checks.register()
+def check_presence_store(app_configs, **kwargs):
+    # Presence written by the socket processes has to be readable by the web processes and the reaper
+    if settings.PRESENCE_STORE == "posapp.presence.CachePresenceStore" and \
+            settings.CACHES["default"]["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache":
+        return [checks.Warning(
+            "CachePresenceStore needs a cache shared by all processes, LocMemCache is per process",
+            hint="Fine for runserver, in production configure a shared CACHE_BACKEND such as Redis or Memcached",
+            id="posapp.W001",
+        )]
+    return []
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    with _stores_lock:
+        if settings.PRESENCE_STORE not in _stores:
+            _stores[settings.PRESENCE_STORE] = import_string(settings.PRESENCE_STORE)()
+        return _stores[settings.PRESENCE_STORE]
+
+
+def broadcast_message(counts):
+    return {
+        "type": "online_status.update",
+        "updates": counts,
+    }
+
+
+class PresenceBroadcaster:
+    # Collects the users whose presence changed and sends managers their current counts in one message every
+    # PRESENCE_BROADCAST_DELAY, so a shift logging in at once costs a handful of messages instead of one per socket.
+    def __init__(self):
+        self.pending = set()
+        self.flushing = None
+
+    def announce(self, username):
+        self.pending.add(username)
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        try:
+            await asyncio.sleep(settings.PRESENCE_BROADCAST_DELAY)
+        finally:
+            self.flushing = None
+        usernames, self.pending = self.pending, set()
+        counts = await database_sync_to_async(get_store().counts)(usernames)
+        await get_channel_layer().group_send("notifications_manager", broadcast_message(counts))
+
+
+# One broadcaster per event loop, its flush task can only run on the loop it was created on
+_broadcasters = weakref.WeakKeyDictionary()
+
+
+def get_broadcaster():
+    loop = asyncio.get_event_loop()
+    if loop not in _broadcasters:
+        _broadcasters[loop] = PresenceBroadcaster()
+    return _broadcasters[loop]
@@ -4,6 +4,5 @@ from django.urls import path
 from posapp import consumers
 
 websocket_urlpatterns = URLRouter([
-    path('notifications/user', consumers.Notifications.User),
-    path('notifications/manager', consumers.Notifications.Manager),
+    path('stream', consumers.Stream),
 ])
@@ -12,4 +12,4 @@ class TabListSerializer(serializers.ModelSerializer):
     totalSpent = SerializerMethodField()
 
     def get_totalSpent(self, obj):
-        return obj.total
+        return getattr(obj, "total_spent", obj.total)
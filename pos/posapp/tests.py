@@ -1,3 +1,975 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.db import connection, IntegrityError, transaction
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from posapp import outbox, backpressure
+from posapp.consumers import Stream
+from posapp.models import Tab, Product, ProductInTab, User, OrderVoidRequest, OutboxMessage, \
+    UserNotification, Currency, PaymentMethod, Deposit, Till, TillEdit, PaymentInTab, TillLedgerEntry, \
+    TillMoneyCount, SyncedOrder
+from posapp.presence import MemoryPresenceStore, CachePresenceStore, DatabasePresenceStore, check_presence_store
+from posapp.tills import TillSummary, verify_ledger
+
+
+class WaiterTabsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.products = [Product.objects.create(name=f"Product {i}", price=Decimal(10 + i)) for i in range(3)]
+
+    def open_tabs(self, count):
+        for i in range(count):
+            tab = Tab.objects.create(name=f"Tab {Tab.objects.count()}", owner=self.user)
+            for product in self.products:
+                tab.order_product(product, 2, "", ProductInTab.ORDERED)
+                tab.order_product(product, 1, "note", ProductInTab.SERVED)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("waiter/tabs"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_tab_count(self):
+        self.open_tabs(2)
+        few = self.count_queries()
+        self.open_tabs(20)
+        many = self.count_queries()
+        self.assertEqual(few, many)
+
+    def test_tab_dicts_are_grouped(self):
+        self.open_tabs(1)
+        response = self.client.get(reverse("waiter/tabs"))
+        tab = response.context["tabs"][0]
+        self.assertEqual(tab["total"], Decimal(3 * (10 + 11 + 12)))
+        self.assertEqual(len(tab["products"]), 3)
+        for product in tab["products"]:
+            self.assertEqual([(variant["orderedCount"], variant["servedCount"]) for variant in product["variants"]],
+                             [(2, 0), (0, 1)])
+
+
+class TabHistoryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="manager", password="manager", is_waiter=True,
+                                             is_manager=True)
+        self.client.force_login(self.user)
+        closed_at = timezone.now()
+        for i in range(7):
+            tab = Tab.objects.create(name=f"Tab {i}", owner=self.user, state=Tab.PAID, closedAt=closed_at)
+            Tab.objects.filter(pk=tab.pk).update(orderedTotal=10 * i)
+
+    def test_keyset_pages_cover_every_tab_once(self):
+        seen = []
+        cursor = ""
+        while True:
+            response = self.client.get(reverse("manager/tab_history"), {"page_length": 3, "before": cursor})
+            page = response.context["tabs"]
+            seen += [tab.name for tab in page["data"]]
+            if not page["pages"]["showNext"]:
+                break
+            cursor = page["pages"]["next"]
+        self.assertEqual(sorted(seen), sorted(f"Tab {i}" for i in range(7)))
+
+    def test_tabs_without_closing_time_are_listed_last(self):
+        for i in range(2):
+            Tab.objects.create(name=f"Unclosed {i}", owner=self.user, state=Tab.PAID)
+        seen = []
+        cursor = ""
+        while True:
+            response = self.client.get(reverse("manager/tab_history"), {"page_length": 2, "before": cursor})
+            self.assertEqual(response.status_code, 200)
+            page = response.context["tabs"]
+            seen += [tab.name for tab in page["data"]]
+            if not page["pages"]["showNext"]:
+                break
+            cursor = page["pages"]["next"]
+        self.assertEqual(len(seen), 9)
+        self.assertEqual(sorted(seen[-2:]), ["Unclosed 0", "Unclosed 1"])
+        self.assertEqual(sorted(seen[:-2]), sorted(f"Tab {i}" for i in range(7)))
+
+    def test_totals_are_annotated(self):
+        response = self.client.get(reverse("manager/tab_history"))
+        totals = {tab.name: tab.total_price for tab in response.context["tabs"]["data"]}
+        self.assertEqual(totals["Tab 3"], 30)
+
+    def test_invalid_page_length_falls_back(self):
+        for page_length, expected in (("x", 20), ("-1", 1), ("0", 1), ("5000", 1000)):
+            response = self.client.get(reverse("manager/tab_history"), {"page_length": page_length})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context["tabs"]["pages"]["page_length"]["value"], expected)
+
+
+class TabListApiTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        for i in range(5):
+            tab = Tab.objects.create(name=f"Tab {i}", owner=self.user)
+            Tab.objects.filter(pk=tab.pk).update(orderedTotal=10 * i, voidedTotal=i)
+        Tab.objects.create(name="Paid", owner=self.user, state=Tab.PAID)
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, json.loads(body)
+
+    def walk(self, url):
+        names = []
+        cursor = ""
+        while True:
+            status_code, page = self.get(url, page_length=2, cursor=cursor)
+            self.assertEqual(status_code, 200)
+            self.assertLessEqual(len(page["results"]), 2)
+            names += [tab["name"] for tab in page["results"]]
+            if page["next"] is None:
+                return names
+            cursor = page["next"]
+
+    def test_cursor_pages_cover_every_tab_once(self):
+        self.assertEqual(sorted(self.walk("/api/1/tabs")), [f"Tab {i}" for i in range(5)])
+        self.assertEqual(sorted(self.walk("/api/1/tabs/all")), ["Paid"] + [f"Tab {i}" for i in range(5)])
+
+    def test_total_spent_is_annotated(self):
+        status_code, page = self.get("/api/1/tabs")
+        totals = {tab["name"]: Decimal(tab["totalSpent"]) for tab in page["results"]}
+        self.assertEqual(totals["Tab 3"], 27)
+        self.assertIsNone(page["next"])
+
+    def test_invalid_parameters_are_rejected(self):
+        for params in ({"cursor": "not a cursor"}, {"page_length": "x"}):
+            for url in ("/api/1/tabs", "/api/1/tabs/all"):
+                self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class TabBatchOrderTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.wine = Product.objects.create(name="Wine", price=Decimal(70))
+
+    def post(self, lines):
+        return self.client.post(f"/api/1/tabs/{self.tab.id}/orders", lines, content_type="application/json")
+
+    def test_lines_are_inserted_together(self):
+        response = self.post([
+            {"product": str(self.beer.id), "amount": 3, "note": "", "state": ProductInTab.ORDERED},
+            {"product": str(self.wine.id), "amount": 2, "note": "red", "state": ProductInTab.SERVED},
+        ])
+        self.assertEqual(response.status_code, 201)
+        orders = ProductInTab.objects.filter(tab=self.tab)
+        self.assertEqual(sorted(orders.values_list("quantity", flat=True)), [2, 3])
+        self.assertEqual(orders.values("orderedAt").distinct().count(), 1)
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.total, Decimal(3 * 40 + 2 * 70))
+
+    def test_invalid_line_rejects_the_whole_batch(self):
+        response = self.post([
+            {"product": str(self.beer.id), "amount": 3, "note": "", "state": ProductInTab.ORDERED},
+            {"product": str(self.wine.id), "amount": 0, "note": "", "state": ProductInTab.ORDERED},
+        ])
+        self.assertEqual(response.status_code, 406)
+        self.assertFalse(ProductInTab.objects.filter(tab=self.tab).exists())
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.total, 0)
+
+    def test_malformed_lines_are_rejected(self):
+        line = {"product": str(self.beer.id), "amount": 1, "note": None, "state": ProductInTab.ORDERED}
+        for field, value in (("product", [str(self.beer.id)]), ("product", {"id": 1}), ("amount", True),
+                             ("amount", "2"), ("note", 3), ("state", None)):
+            self.assertEqual(self.post([{**line, field: value}]).status_code, 400, (field, value))
+        self.assertFalse(ProductInTab.objects.filter(tab=self.tab).exists())
+        self.assertEqual(self.post([line]).status_code, 201)
+
+
+class OrderSyncTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+
+    def sync(self, *keys):
+        return self.client.post("/api/1/orders/sync", {"operations": [
+            {"key": key, "tab": str(self.tab.id), "product": str(self.beer.id), "amount": 2, "note": "",
+             "state": ProductInTab.ORDERED} for key in keys
+        ]}, content_type="application/json")
+
+    def test_resent_operations_are_skipped(self):
+        first = self.sync("a", "b").json()
+        self.assertEqual(first["applied"], ["a", "b"])
+        second = self.sync("a", "b", "c").json()
+        self.assertEqual((second["applied"], second["skipped"]), (["c"], ["a", "b"]))
+        self.tab.refresh_from_db()
+        self.assertEqual(sum(ProductInTab.objects.filter(tab=self.tab).values_list("quantity", flat=True)), 6)
+        self.assertEqual(second["tabs"], {str(self.tab.id): self.tab.version})
+
+    def test_failed_operation_rolls_back_the_batch(self):
+        self.sync("a")
+        response = self.client.post("/api/1/orders/sync", {"operations": [
+            {"key": "b", "tab": str(self.tab.id), "product": str(self.beer.id), "amount": 1, "note": "",
+             "state": ProductInTab.ORDERED},
+            {"key": "c", "tab": str(self.tab.id), "product": str(self.tab.id), "amount": 1, "note": "",
+             "state": ProductInTab.ORDERED},
+        ]}, content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["keys"], ["c"])
+        self.assertEqual(sum(ProductInTab.objects.filter(tab=self.tab).values_list("quantity", flat=True)), 2)
+
+    def test_malformed_operations_are_rejected_by_key(self):
+        operation = {"key": "a", "tab": str(self.tab.id), "product": str(self.beer.id), "amount": 1, "note": "",
+                     "state": ProductInTab.ORDERED}
+        for field, value in (("tab", [str(self.tab.id)]), ("tab", {"id": 1}), ("product", [str(self.beer.id)]),
+                             ("amount", True)):
+            response = self.client.post("/api/1/orders/sync", {"operations": [{**operation, field: value}]},
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 400, (field, value))
+            self.assertEqual(response.json()["keys"], ["a"])
+        self.assertFalse(ProductInTab.objects.filter(tab=self.tab).exists())
+
+    def test_batch_losing_a_race_is_applied_again(self):
+        bulk_create = SyncedOrder.objects.bulk_create
+        calls = []
+
+        # The first attempt collides with a concurrent resend that recorded the key in the meantime
+        def racing_bulk_create(orders):
+            calls.append(orders)
+            if len(calls) == 1:
+                raise IntegrityError("UNIQUE constraint failed: posapp_syncedorder.key")
+            return bulk_create(orders)
+
+        with mock.patch.object(SyncedOrder.objects, "bulk_create", side_effect=racing_bulk_create):
+            response = self.sync("a")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sum(ProductInTab.objects.filter(tab=self.tab).values_list("quantity", flat=True)), 2)
+
+
+class OrderQuantityTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.order, = self.tab.order_products([(self.beer, 5, "", ProductInTab.ORDERED)])
+
+    def states(self):
+        return sorted(ProductInTab.objects.filter(tab=self.tab).values_list("state", "quantity"))
+
+    def test_bumping_part_of_an_order_splits_it(self):
+        self.order.bump(2)
+        self.assertEqual(self.states(), [(ProductInTab.ORDERED, 3), (ProductInTab.PREPARING, 2)])
+        self.order.bump()
+        self.assertEqual(self.states(), [(ProductInTab.ORDERED, 3), (ProductInTab.TO_SERVE, 2)])
+
+    def test_voiding_part_of_an_order_splits_it(self):
+        self.order.void(2)
+        self.assertEqual(self.states(), [(ProductInTab.ORDERED, 3), (ProductInTab.VOIDED, 2)])
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.total, Decimal(3 * 40))
+        self.assertEqual(self.tab.calculate_totals()["voidedTotal"], Decimal(2 * 40))
+
+
+class TabTotalsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(3))
+
+    def assertTotalsConsistent(self):
+        self.tab.refresh_from_db()
+        totals = self.tab.calculate_totals()
+        self.assertEqual({field: getattr(self.tab, field) for field in totals}, totals)
+
+    def test_running_totals_follow_orders_and_voids(self):
+        order, = self.tab.order_products([(self.beer, 2, "", ProductInTab.ORDERED)])
+        self.tab.order_products([(self.beer, 1, "note", ProductInTab.SERVED)])
+        self.assertTotalsConsistent()
+        self.assertEqual(self.tab.total, 9)
+        order.void(1)
+        self.assertTotalsConsistent()
+        self.assertEqual(self.tab.total, 6)
+
+    def test_voiding_twice_counts_once(self):
+        order, = self.tab.order_products([(self.beer, 2, "", ProductInTab.ORDERED)])
+        stale = ProductInTab.objects.get(pk=order.pk)
+        order.void()
+        stale.void()
+        self.assertTotalsConsistent()
+        self.assertEqual(self.tab.total, 0)
+
+    def test_rebuild_command(self):
+        self.tab.order_products([(self.beer, 2, "", ProductInTab.ORDERED)])
+        call_command("rebuild_tab_totals", "--check", stdout=StringIO())
+        Tab.objects.filter(pk=self.tab.pk).update(orderedTotal=100)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_tab_totals", "--check", stdout=StringIO())
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.orderedTotal, 100)
+
+        call_command("rebuild_tab_totals", stdout=StringIO())
+        self.assertTotalsConsistent()
+        call_command("rebuild_tab_totals", "--check", stdout=StringIO())
+
+
+class TicketTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="manager", password="manager", is_waiter=True,
+                                             is_manager=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.wine = Product.objects.create(name="Wine", price=Decimal(70))
+        self.orders = self.tab.order_products([(self.beer, 2, "", ProductInTab.ORDERED),
+                                               (self.wine, 1, "", ProductInTab.PREPARING)], self.user)
+        self.ticket = self.orders[0].ticket
+
+    def states(self):
+        return sorted(self.ticket.productintab_set.values_list("product__name", "state"))
+
+    def test_bump_advances_every_order_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.ticket.bump()
+        self.assertEqual(self.states(), [("Beer", ProductInTab.PREPARING), ("Wine", ProductInTab.TO_SERVE)])
+        for order in self.ticket.productintab_set.all():
+            order.clean()
+
+    def test_bump_can_be_limited_to_one_state(self):
+        self.client.get(reverse("waiter/orders/ticket/bump", kwargs={"id": self.ticket.id}),
+                        {"state": ProductInTab.ORDERED})
+        self.assertEqual(self.states(), [("Beer", ProductInTab.PREPARING), ("Wine", ProductInTab.PREPARING)])
+
+    def test_void_updates_the_tab_total(self):
+        self.client.get(reverse("waiter/orders/ticket/void", kwargs={"id": self.ticket.id}))
+        self.assertEqual(self.states(), [("Beer", ProductInTab.VOIDED), ("Wine", ProductInTab.VOIDED)])
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.total, 0)
+
+    def test_kitchen_groups_orders_by_ticket(self):
+        response = self.client.get(reverse("waiter/orders"))
+        self.assertEqual([ticket["id"] for ticket in response.context["waiting"]], [self.ticket.id])
+
+
+class KitchenBoardTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+
+    def test_served_list_is_limited_to_recent_orders(self):
+        old, recent = self.tab.order_products([(self.beer, 1, "old", ProductInTab.SERVED),
+                                               (self.beer, 1, "recent", ProductInTab.SERVED)])
+        ProductInTab.objects.filter(pk=old.pk).update(servedAt=timezone.now() - timedelta(days=1))
+        response = self.client.get(reverse("waiter/orders/board"))
+        self.assertEqual([order.note for order in response.context["served"]], ["recent"])
+
+    def test_board_query_count_does_not_depend_on_order_count(self):
+        self.tab.order_products([(self.beer, 1, "", ProductInTab.ORDERED)])
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse("waiter/orders/board"))
+        for state in [ProductInTab.ORDERED, ProductInTab.PREPARING, ProductInTab.TO_SERVE, ProductInTab.SERVED]:
+            tab = Tab.objects.create(name=f"Tab {state}", owner=self.user)
+            tab.order_products([(self.beer, 1, "", state)] * 5)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse("waiter/orders/board"))
+        self.assertEqual(len(few), len(many))
+
+
+class NotificationCountersTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="manager", password="manager", is_waiter=True,
+                                             is_manager=True)
+        self.client.force_login(self.user)
+        tab = Tab.objects.create(name="Tab", owner=self.user)
+        beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.orders = tab.order_products([(beer, 1, "", ProductInTab.ORDERED), (beer, 1, "x", ProductInTab.ORDERED)])
+
+    def notification_count(self):
+        response = self.client.get(reverse("waiter/orders"))
+        return sum(notification.count for notification in response.context["notifications"])
+
+    def test_counts_follow_requests_and_are_cached(self):
+        self.assertEqual(self.notification_count(), 0)
+        requests = [OrderVoidRequest.objects.create(order=order, waiter=self.user) for order in self.orders]
+        self.assertEqual(self.notification_count(), 2)
+        requests[0].reject(self.user)
+        self.assertEqual(self.notification_count(), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.notification_count()
+        self.assertFalse([query for query in queries if "posapp_ordervoidrequest" in query["sql"]])
+
+
+class PresenceStoreTestCase(TestCase):
+    def check_store(self, store):
+        store.touch("waiter", "a", ttl=60)
+        store.touch("waiter", "b", ttl=60)
+        store.touch("manager", "c", ttl=-1)
+        self.assertEqual(store.counts(["waiter", "manager", "nobody"]), {"waiter": 2, "manager": 0, "nobody": 0})
+        self.assertEqual(store.reap(), {"manager": 0})
+        self.assertEqual(store.reap(), {})
+        store.remove("waiter", "a")
+        self.assertEqual(store.counts(["waiter"]), {"waiter": 1})
+
+    def test_memory_store(self):
+        self.check_store(MemoryPresenceStore())
+
+    def test_cache_store(self):
+        self.check_store(CachePresenceStore())
+
+    def test_database_store(self):
+        store = DatabasePresenceStore()
+        self.check_store(store)
+        self.assertFalse(store.touch("waiter", "b", ttl=60))
+        self.assertTrue(store.touch("waiter", "a", ttl=60))
+
+    def test_cache_store_on_a_per_process_cache_is_warned_about(self):
+        self.assertEqual([warning.id for warning in check_presence_store(None)], ["posapp.W001"])
+        with override_settings(PRESENCE_STORE="posapp.presence.DatabasePresenceStore"):
+            self.assertEqual(check_presence_store(None), [])
+
+
+async def open_stream(user, *subscriptions):
+    communicator = WebsocketCommunicator(Stream, "/ws/posapp/stream")
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    for subscription in subscriptions:
+        await communicator.send_json_to({"type": "subscribe", **subscription})
+        message = await communicator.receive_json_from()
+        assert message["data"]["notification_type"] == "subscribed", message
+    return communicator
+
+
+@override_settings(PRESENCE_STORE="posapp.presence.MemoryPresenceStore", PRESENCE_BROADCAST_DELAY=0.1)
+class PresenceBroadcastTestCase(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username="broadcast_manager", password="manager", is_manager=True)
+        self.waiters = [User.objects.create_user(username=f"broadcast_waiter{i}", password="waiter", is_waiter=True)
+                        for i in range(3)]
+
+    @async_to_sync
+    async def test_connects_are_coalesced_for_managers(self):
+        manager = await open_stream(self.manager, {"topic": "manager"})
+        sockets = [await open_stream(waiter, {"topic": "user"}) for waiter in self.waiters * 2]
+        message = await manager.receive_json_from(timeout=2)
+        self.assertEqual(message["topic"], "manager")
+        self.assertEqual(message["data"]["notification_type"], "online_status_update")
+        # The manager's own page counts as well, there is one socket per page
+        self.assertEqual(message["data"]["updates"], {self.manager.username: 1,
+                                                      **{waiter.username: 2 for waiter in self.waiters}})
+        self.assertTrue(await manager.receive_nothing(timeout=0.3))
+        # Plain users get no presence traffic at all, only their inbox
+        self.assertEqual((await sockets[0].receive_json_from())["data"]["notification_type"], "inbox_replay")
+        self.assertTrue(await sockets[0].receive_nothing())
+
+        for socket in sockets[:3]:
+            await socket.disconnect()
+        message = await manager.receive_json_from(timeout=2)
+        self.assertEqual(message["data"]["updates"], {waiter.username: 1 for waiter in self.waiters})
+        for socket in sockets[3:]:
+            await socket.disconnect()
+        await manager.disconnect()
+
+    @async_to_sync
+    async def test_topics_need_the_right_role(self):
+        waiter = await open_stream(self.waiters[0])
+        await waiter.send_json_to({"type": "subscribe", "topic": "manager"})
+        message = await waiter.receive_json_from()
+        self.assertEqual((message["topic"], message["data"]["notification_type"]),
+                         ("manager", "subscription_refused"))
+        await waiter.disconnect()
+
+
+class OutboundQueueTestCase(SimpleTestCase):
+    def test_superseded_messages_are_merged(self):
+        queue = backpressure.OutboundQueue(10)
+        queue.push("manager", {"notification_type": "online_status_update", "updates": {"a": 1, "b": 1}},
+                   backpressure.merge_presence)
+        queue.push("manager", {"notification_type": "void_request"})
+        queue.push("manager", {"notification_type": "online_status_update", "updates": {"a": 0}},
+                   backpressure.merge_presence)
+        queue.push("tab:1", {"notification_type": "tab_state", "version": 3, "lines": [
+            {"product": "p", "note": "", "ordered": 1}, {"product": "q", "note": "", "ordered": 1}]},
+                   backpressure.merge_tab_states)
+        queue.push("tab:1", {"notification_type": "tab_state", "version": 2, "lines": [
+            {"product": "p", "note": "", "ordered": 0}]}, backpressure.merge_tab_states)
+
+        self.assertEqual((len(queue), queue.queued, queue.coalesced), (3, 3, 2))
+        self.assertEqual(queue.pop()["data"]["updates"], {"a": 0, "b": 1})
+        self.assertEqual(queue.pop()["data"]["notification_type"], "void_request")
+        state = queue.pop()["data"]
+        self.assertEqual(state["version"], 3)
+        self.assertEqual([line["ordered"] for line in state["lines"]], [1, 1])
+        # A popped message is out of reach, the next one queues again
+        queue.push("tab:1", {"notification_type": "tab_state", "version": 4, "lines": []},
+                   backpressure.merge_tab_states)
+        self.assertEqual(len(queue), 1)
+
+    def test_overflow_drops_everything(self):
+        queue = backpressure.OutboundQueue(2)
+        self.assertTrue(queue.push("user", {"notification_type": "a"}))
+        self.assertTrue(queue.push("user", {"notification_type": "b"}))
+        self.assertFalse(queue.push("user", {"notification_type": "c"}))
+        self.assertFalse(queue.push("user", {"notification_type": "d"}))
+        self.assertEqual((len(queue), queue.overflowed, queue.dropped, queue.peak), (0, True, 4, 2))
+
+
+@override_settings(PRESENCE_STORE="posapp.presence.MemoryPresenceStore", STREAM_SEND_WINDOW=2,
+                   STREAM_QUEUE_LIMIT=3)
+class StreamBackpressureTestCase(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username="slow_manager", password="manager", is_manager=True)
+        backpressure.reset_metrics()
+
+    @staticmethod
+    def void_request(number):
+        return {"type": "notification.void_request", "void_request": {"notification_type": "void_request",
+                                                                      "number": number}}
+
+    @async_to_sync
+    async def test_sends_wait_for_acknowledgements(self):
+        manager = await open_stream(self.manager, {"topic": "manager"})
+        await manager.send_json_to({"type": "ack", "seq": 1})
+        channel_layer = get_channel_layer()
+        for number in range(3):
+            await channel_layer.group_send("notifications_manager", self.void_request(number))
+        first = await manager.receive_json_from()
+        second = await manager.receive_json_from()
+        self.assertEqual([first["seq"], second["seq"]], [2, 3])
+        self.assertTrue(await manager.receive_nothing())
+
+        await manager.send_json_to({"type": "ack", "seq": 2})
+        third = await manager.receive_json_from()
+        self.assertEqual((third["seq"], third["data"]["number"]), (4, 2))
+        await manager.disconnect()
+
+    @async_to_sync
+    async def test_slow_client_is_closed(self):
+        manager = await open_stream(self.manager, {"topic": "manager"})
+        channel_layer = get_channel_layer()
+        # Presence updates merge, so they never fill the queue on their own
+        for number in range(10):
+            await channel_layer.group_send("notifications_manager", {"type": "online_status.update",
+                                                                     "updates": {f"user{number}": 1}})
+        self.assertEqual((await manager.receive_json_from())["data"]["notification_type"], "online_status_update")
+        self.assertTrue(await manager.receive_nothing())
+
+        for number in range(5):
+            await channel_layer.group_send("notifications_manager", self.void_request(number))
+        self.assertEqual((await manager.receive_output())["code"], backpressure.SLOW_CLIENT_CLOSE_CODE)
+        await manager.disconnect()
+
+        metrics = await sync_to_async(backpressure.get_metrics)()
+        self.assertEqual((metrics["connections"], metrics["slow_closes"], metrics["coalesced"]), (1, 1, 8))
+        self.assertGreater(metrics["dropped"], 0)
+
+    def test_metrics_add_up_across_sockets(self):
+        for peak in (3, 1):
+            queue = backpressure.OutboundQueue(limit=10)
+            for number in range(peak):
+                queue.push("manager", {"notification_type": str(number)})
+            backpressure.record_metrics(queue)
+        self.assertEqual(backpressure.get_metrics(), {"connections": 2, "queued": 4, "coalesced": 0, "dropped": 0,
+                                                      "slow_closes": 0, "peak_queue": 3})
+        out = StringIO()
+        call_command("stream_metrics", "--reset", stdout=out)
+        self.assertIn("queued       4", out.getvalue())
+        self.assertEqual(backpressure.get_metrics()["connections"], 0)
+
+
+class BenchmarkWebsocketsTestCase(SimpleTestCase):
+    def test_small_run_reports(self):
+        # Run apart, the command sets up its own test database. The database presence store must not leak in.
+        result = subprocess.run(
+            [sys.executable, os.path.join(settings.BASE_DIR, "manage.py"), "benchmark_websockets", "--sockets", "6",
+             "--users", "2", "--managers", "1", "--events", "1", "--memory-sample", "5"],
+            env={**os.environ, "PRESENCE_STORE": "posapp.presence.DatabasePresenceStore"},
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("6 user sockets, 1 manager sockets", result.stdout)
+        self.assertIn("presence", result.stdout)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        tab = Tab.objects.create(name="Tab", owner=self.user)
+        beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.order = tab.order_products([(beer, 2, "", ProductInTab.ORDERED)])[0]
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)("notifications_manager", self.channel)
+
+    def tearDown(self):
+        async_to_sync(self.channel_layer.flush)()
+
+    def request_void(self):
+        self.client.get(reverse("waiter/orders/order/request_void", kwargs={"id": self.order.id}))
+
+    def test_messages_are_sent_only_by_the_dispatcher(self):
+        self.request_void()
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.group, "notifications_manager")
+        self.assertEqual(message.message["void_request"]["order"]["quantity"], 1)
+
+        self.assertEqual(outbox.dispatch(), (1, 0))
+        received = async_to_sync(self.channel_layer.receive)(self.channel)
+        self.assertEqual(received["type"], "notification.void_request")
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failed_sends_are_retried_later(self):
+        self.request_void()
+        with mock.patch.object(self.channel_layer, "group_send", side_effect=ConnectionError):
+            self.assertEqual(outbox.dispatch(), (0, 1))
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertGreater(message.nextAttemptAt, timezone.now())
+        self.assertEqual(outbox.dispatch(), (0, 0))
+
+        OutboxMessage.objects.update(nextAttemptAt=timezone.now())
+        self.assertEqual(outbox.dispatch(), (1, 0))
+
+    def test_a_message_is_claimed_by_one_dispatcher(self):
+        self.request_void()
+        self.request_void()
+        first = outbox.claim()
+        self.assertEqual(len(first), OutboxMessage.objects.count())
+        self.assertEqual(outbox.claim(), [])
+        self.assertEqual(outbox.dispatch(), (0, 0))
+
+        # A dispatcher that died leaves its batch to be claimed again
+        OutboxMessage.objects.update(nextAttemptAt=timezone.now())
+        self.assertEqual(outbox.dispatch(), (len(first), 0))
+        self.assertFalse(OutboxMessage.objects.exists())
+
+
+class TabStateTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.wine = Product.objects.create(name="Wine", price=Decimal(50))
+
+    def test_state_endpoint(self):
+        order = self.tab.order_products([(self.beer, 3, "", ProductInTab.ORDERED),
+                                         (self.wine, 1, "", ProductInTab.SERVED)])[0]
+        order.void(1)
+        response = self.client.get(f"/api/1/tabs/{self.tab.id}/state")
+        self.assertEqual(response.status_code, 200)
+        state = response.json()
+        self.assertEqual(Decimal(state["total"]), 130)
+        self.assertEqual({(line["product"], line["ordered"], line["served"], Decimal(line["total"]))
+                          for line in state["lines"]},
+                         {(str(self.beer.id), 2, 0, 80), (str(self.wine.id), 0, 1, 50)})
+
+    @async_to_sync
+    async def test_changes_are_pushed_to_tab_subscribers(self):
+        communicator = await open_stream(self.user, {"topic": "tab", "id": str(self.tab.id)})
+
+        orders = await sync_to_async(self.tab.order_products)([(self.beer, 2, "cold", ProductInTab.ORDERED)])
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["topic"], f"tab:{self.tab.id}")
+        update = message["data"]
+        self.assertEqual(Decimal(update["total"]), 80)
+        self.assertEqual(len(update["lines"]), 1)
+        self.assertEqual(update["lines"][0]["product"], str(self.beer.id))
+        self.assertEqual(update["lines"][0]["note"], "cold")
+        self.assertEqual(update["lines"][0]["ordered"], 2)
+        self.assertEqual(Decimal(update["lines"][0]["total"]), 80)
+
+        await sync_to_async(orders[0].bump)(1)
+        update = (await communicator.receive_json_from())["data"]
+        self.assertEqual((update["lines"][0]["ordered"], update["lines"][0]["preparing"]), (1, 1))
+        await communicator.disconnect()
+
+    def test_missing_note_is_an_empty_note(self):
+        self.tab.order_products([(self.beer, 2, None, ProductInTab.ORDERED), (self.beer, 1, "", ProductInTab.SERVED)])
+        for lines in (None, [(self.beer.id, None)], [(self.beer.id, "")]):
+            self.assertEqual([(line["note"], line["ordered"], line["served"]) for line in self.tab.line_states(lines)],
+                             [("", 2, 1)])
+        response = self.client.get(reverse("waiter/tabs/tab", kwargs={"id": self.tab.id}))
+        self.assertContains(response, 'data-line-note=""')
+        self.assertNotContains(response, 'data-line-note="None"')
+
+
+class FailingChannelLayer:
+    # Raises on sends to the given groups, all groups when none are given
+    def __init__(self, *groups):
+        self.groups = groups
+
+    async def group_send(self, group, message):
+        if not self.groups or group in self.groups:
+            raise ConnectionError("The channel layer is down")
+
+
+class PublishFailureTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.client.force_login(self.user)
+        self.tab = Tab.objects.create(name="Tab", owner=self.user)
+        self.beer = Product.objects.create(name="Beer", price=Decimal(40))
+
+    def order(self):
+        return self.client.post(f"/api/1/tabs/{self.tab.id}/order", {
+            "product": str(self.beer.id), "amount": 2, "note": "", "state": ProductInTab.ORDERED,
+        }, content_type="application/json")
+
+    def test_failed_order_update_does_not_fail_the_request(self):
+        with mock.patch("posapp.models.get_channel_layer", return_value=FailingChannelLayer("orders")), \
+                self.assertLogs("posapp.models", "ERROR"):
+            response = self.order()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ProductInTab.objects.filter(tab=self.tab).count(), 1)
+
+    def test_failed_tab_state_does_not_fail_the_request(self):
+        with mock.patch("posapp.models.get_channel_layer", return_value=FailingChannelLayer()), \
+                mock.patch("posapp.outbox.wake") as wake, self.assertLogs("posapp.models", "ERROR") as logs:
+            response = self.order()
+            # The hooks registered after the failing ones still run
+            with transaction.atomic():
+                ProductInTab.objects.get(tab=self.tab).void()
+                UserNotification.send(self.user, {"type": "test"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(logs.records), 4)
+        wake.assert_called_once()
+        self.tab.refresh_from_db()
+        self.assertEqual(self.tab.total, 0)
+
+
+@override_settings(OUTBOX_DISPATCH_IN_PROCESS=False)
+class UserNotificationTestCase(TransactionTestCase):
+    def setUp(self):
+        self.waiter = User.objects.create_user(username="waiter", password="waiter", is_waiter=True)
+        self.manager = User.objects.create_user(username="manager", password="manager", is_waiter=True,
+                                                is_manager=True)
+        tab = Tab.objects.create(name="Tab", owner=self.waiter)
+        beer = Product.objects.create(name="Beer", price=Decimal(40))
+        self.orders = tab.order_products([(beer, 1, "", ProductInTab.ORDERED), (beer, 1, "x", ProductInTab.ORDERED)])
+
+    def resolve_void_request(self, order):
+        OrderVoidRequest.objects.create(order=order, waiter=self.waiter).reject(self.manager)
+        return UserNotification.objects.latest("id")
+
+    async def connect(self, **cursor):
+        communicator = await open_stream(self.waiter, {"topic": "user", **cursor})
+        replay = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return replay["data"]
+
+    @async_to_sync
+    async def test_reconnecting_socket_replays_missed_notifications(self):
+        first = await sync_to_async(self.resolve_void_request)(self.orders[0])
+        second = await sync_to_async(self.resolve_void_request)(self.orders[1])
+
+        replay = await self.connect()
+        self.assertEqual((replay["notifications"], replay["cursor"]), ([], second.id))
+
+        replay = await self.connect(after=first.id)
+        self.assertEqual([notification["sequence"] for notification in replay["notifications"]], [second.id])
+        self.assertEqual(replay["notifications"][0]["notification_type"], "void_request_resolved")
+        self.assertEqual(replay["cursor"], second.id)
+
+    def test_old_notifications_are_pruned(self):
+        old = self.resolve_void_request(self.orders[0])
+        new = self.resolve_void_request(self.orders[1])
+        UserNotification.objects.filter(id=old.id).update(createdAt=timezone.now() - timedelta(days=30))
+        call_command("prune_notifications", days=7, stdout=StringIO())
+        self.assertEqual(list(UserNotification.objects.values_list("id", flat=True)), [new.id])
+
+
+@override_settings(TILL_LEDGER_SNAPSHOT_INTERVAL=3)
+class TillSummaryTestCase(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username="till_manager", password="manager", is_manager=True)
+        self.client.force_login(self.manager)
+        currency = Currency.objects.create(name="Crown", code="CZK", subunit="haler", enabled=True)
+        self.cash, self.card = [PaymentMethod.objects.create(name=name, currency=currency, changeAllowed=True,
+                                                             _enabled=True) for name in ("Cash", "Card")]
+        deposit = Deposit.objects.create(name="Bar", changeMethod=self.cash, depositAmount=Decimal(1000))
+        deposit.methods.set([self.cash, self.card])
+        self.till = deposit.create_till()
+        cash_count = self.till.tillmoneycount_set.get(paymentMethod=self.cash)
+        card_count = self.till.tillmoneycount_set.get(paymentMethod=self.card)
+
+        self.tab = tab = Tab.objects.create(name="Till tab", owner=self.manager)
+        for amount in (10, 20, 30):
+            PaymentInTab.objects.create(tab=tab, method=cash_count, amount=Decimal(amount))
+        PaymentInTab.objects.create(tab=tab, method=card_count, amount=Decimal(25))
+        cash_count.amount = Decimal(50)
+        cash_count.save()
+        card_count.amount = Decimal(25)
+        card_count.save()
+        TillEdit.objects.create(count=cash_count, amount=Decimal(5), reason="Found under the till")
+        TillEdit.objects.create(count=cash_count, amount=Decimal(-1), reason="Miscounted")
+
+    def test_summary_is_one_query(self):
+        with self.assertNumQueries(1):
+            summary = TillSummary(self.till)
+            names = [count.paymentMethod.name for count in summary.counts]
+        self.assertEqual(names, ["Card", "Cash"])
+        self.assertEqual([(count.expected_amount, count.counted_amount, count.variance) for count in summary.counts],
+                         [(25, 25, 0), (60, 54, -6)])
+        self.assertEqual((summary.expected, summary.counted, summary.variance), (85, 79, -6))
+        count = summary.counts[1]
+        self.assertEqual((count.expected, count.counted), (count.expected_amount, count.counted_amount))
+
+    def test_till_pages(self):
+        self.till.stop()
+        response = self.client.get(reverse("manager/tills/till/count", kwargs={"id": self.till.id}))
+        self.assertEqual(response.context["totals"]["variance"], -10)
+        self.till.close(response.wsgi_request)
+        response = self.client.get(reverse("manager/tills/till", kwargs={"id": self.till.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["totals"]["counted"], 79)
+        self.assertEqual([edit.reason for edit in response.context["edits"]], ["Found under the till", "Miscounted"])
+        response = self.client.get(reverse("manager/tills/till/edit", kwargs={"id": self.till.id}))
+        self.assertEqual(len(response.context["counts"]), 2)
+
+    def test_ledger_keeps_running_balances(self):
+        count = self.till.tillmoneycount_set.get(paymentMethod=self.cash)
+        before = timezone.now()
+        payment = PaymentInTab.objects.create(tab=self.tab, method=count, amount=Decimal("7.5"))
+        payment.amount = Decimal(8)
+        payment.save()
+        payment.delete()
+        entries = count.ledger.order_by("sequence")
+        self.assertEqual([(entry.kind, entry.amount, entry.paid, entry.edited) for entry in entries][-5:], [
+            ("E", -1, 60, 4), ("P", Decimal("7.5"), Decimal("67.5"), 4), ("R", Decimal("-7.5"), 60, 4),
+            ("P", 8, 68, 4), ("R", -8, 60, 4),
+        ])
+        self.assertEqual((count.balance(before).paid, count.expected, count.counted), (60, 60, 54))
+        self.assertEqual(count.ledger_snapshots.count(), 3)
+        self.assertEqual(verify_ledger(count, full=True), [])
+        self.assertEqual(verify_ledger(count), [])
+
+        entry = count.ledger.get(sequence=2)
+        TillLedgerEntry.objects.filter(pk=entry.pk).update(amount=25, paid=35)
+        self.assertEqual(len(verify_ledger(count, full=True)), 2)
+        with self.assertRaises(CommandError):
+            call_command("verify_till_ledger", "--full", stderr=StringIO())
+        with self.assertRaises(ValidationError):
+            entry.delete()
+
+
+class ManagerTillsTestCase(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username="tills_manager", password="manager", is_manager=True)
+        self.client.force_login(self.manager)
+        currency = Currency.objects.create(name="Crown", code="CZK", subunit="haler", enabled=True)
+        cash = PaymentMethod.objects.create(name="Cash", currency=currency, changeAllowed=True, _enabled=True)
+        self.deposits = [Deposit.objects.create(name=name, changeMethod=cash, depositAmount=Decimal(1000))
+                         for name in ("Bar", "Terrace")]
+        self.cashiers = [User.objects.create_user(username=f"cashier{i}", password="waiter", is_waiter=True,
+                                                  first_name="Jane", last_name=f"Doe{i}") for i in range(12)]
+
+    def assign(self, count):
+        for i in range(count):
+            self.deposits[i % 2].create_till(self.cashiers[2 * i:2 * i + 2])
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("manager/tills"), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_tills_are_listed_once_with_all_cashiers(self):
+        self.assign(2)
+        response, _ = self.get(search="doe1")
+        tills = list(response.context["open"]["data"])
+        self.assertEqual([till.cashier_names for till in tills], ["Jane Doe0 and Jane Doe1"])
+        self.assertEqual(list(response.context["deposits"]), ["Bar"])
+
+        response, _ = self.get()
+        self.assertEqual(len(response.context["open"]["data"]), 2)
+        self.assertEqual(list(response.context["deposits"]), ["Bar", "Terrace"])
+        response, _ = self.get(deposit_filter="Terrace")
+        self.assertEqual([till.cashier_names for till in response.context["open"]["data"]],
+                         ["Jane Doe2 and Jane Doe3"])
+
+    def test_till_without_cashiers(self):
+        till = self.deposits[0].create_till([])
+        self.assertEqual(Till.with_cashier_names().get(pk=till.pk).cashier_names, "Nobody is assigned")
+        response, _ = self.get()
+        self.assertEqual([till.cashier_names for till in response.context["open"]["data"]], ["Nobody is assigned"])
+
+    def test_query_count_does_not_depend_on_till_count(self):
+        self.assign(2)
+        self.get()  # fills the header counters
+        _, few = self.get()
+        self.assign(4)
+        _, many = self.get()
+        self.assertEqual(few, many)
+
+    def post_assign(self, usernames):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse("manager/tills/assign"), {
+                "users": usernames, "options": str(self.deposits[0].id)})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_assignment_is_bulk_and_atomic(self):
+        self.deposits[0].methods.set(PaymentMethod.objects.all())
+        self.assign(1)
+        self.get()  # fills the header counters
+        few = self.post_assign([self.cashiers[2].username])
+        many = self.post_assign([cashier.username for cashier in self.cashiers[1:]])
+        self.assertEqual(few, many)
+        till = Till.objects.order_by("openedAt").last()
+        # cashier1 already had a till and cashier2 got one from the first assignment
+        self.assertEqual(sorted(till.cashiers.values_list("username", flat=True)),
+                         sorted(cashier.username for cashier in self.cashiers[3:]))
+        self.assertEqual(User.objects.filter(current_till=till).count(), 9)
+        self.assertEqual(till.tillmoneycount_set.count(), 1)
+
+        tills = Till.objects.count()
+        self.post_assign([self.manager.username, "nobody"])
+        self.assertEqual(Till.objects.count(), tills)
+
+    def test_end_of_night_in_batches(self):
+        self.deposits[0].methods.set(PaymentMethod.objects.all())
+        self.assign(3)
+        tills = list(Till.objects.order_by("openedAt"))
+        url = reverse("manager/tills/end_of_night")
+
+        self.client.post(url, {"stop": "", "tills": [str(till.id) for till in tills[:2]]})
+        self.assertEqual(set(Till.objects.filter(state=Till.STOPPED)), set(tills[:2]))
+        self.assertFalse(User.objects.filter(current_till__in=tills[:2]).exists())
+        self.assertEqual(User.objects.filter(current_till=tills[2]).count(), 2)
+
+        response = self.client.get(url)
+        self.assertEqual({summary.till for summary in response.context["stopped_tills"]}, set(tills[:2]))
+        counts = [tills[i].tillmoneycount_set.get() for i in (0, 2)]
+        response = self.client.post(url, {
+            "close": "", "tills": [str(till.id) for till in tills],
+            f"counted-{counts[0].id}": "120.5", f"counted-{counts[1].id}": "80",
+        }, follow=True)
+        # The second till is on the Terrace deposit without payment methods, the third one is still open
+        self.assertEqual(Till.objects.get(id=tills[0].id).state, Till.COUNTED)
+        self.assertEqual(Till.objects.get(id=tills[1].id).state, Till.COUNTED)
+        self.assertEqual(Till.objects.get(id=tills[2].id).state, Till.OPEN)
+        self.assertEqual(Till.objects.get(id=tills[0].id).countedBy, self.manager)
+        self.assertEqual(TillMoneyCount.objects.get(id=counts[0].id).amount, Decimal("120.5"))
+        self.assertEqual(TillMoneyCount.objects.get(id=counts[1].id).amount, 0)
+        self.assertEqual(len([message for message in response.context["messages"] if message.level_tag == "warning"]),
+                         1)
@@ -0,0 +1,149 @@
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from posapp.models import TillLedgerEntry, Till, TillMoneyCount, User
+
+AMOUNT = models.DecimalField(max_digits=15, decimal_places=3)
+
+
+def latest_balance(field):
+    # The field of the count's last ledger entry, zero while it has none
+    entries = TillLedgerEntry.objects.filter(count=OuterRef("pk")).order_by("-sequence").values(field)[:1]
+    return Coalesce(Subquery(entries, output_field=AMOUNT), Value(Decimal(0)), output_field=AMOUNT)
+
+
+def summarized_counts(counts):
+    # Each count gets expected_amount (payments to it) and edited_amount (its edits)
+    return counts.select_related("paymentMethod").annotate(
+        expected_amount=latest_balance("paid"),
+        edited_amount=latest_balance("edited"),
+    ).order_by("paymentMethod__name")
+
+
+class TillSummary:
+    # Expected, counted and variance of every payment method of a till, for the till detail, Count and Edit pages.
+    # One query reading the last ledger entry of each count, however many payments the till took.
+    def __init__(self, till, counts=None):
+        self.till = till
+        # Each count also gets counted_amount (its amount and edits) and variance
+        self.counts = list(summarized_counts(till.tillmoneycount_set.all())) if counts is None else counts
+        for count in self.counts:
+            count.counted_amount = count.amount + count.edited_amount
+            count.variance = count.counted_amount - count.expected_amount
+
+        self.expected = sum((count.expected_amount for count in self.counts), Decimal(0))
+        self.counted = sum((count.counted_amount for count in self.counts), Decimal(0))
+        self.variance = self.counted - self.expected
+
+    @staticmethod
+    def for_tills(tills):
+        # Summaries of many tills from one query
+        counts = {}
+        for count in summarized_counts(TillMoneyCount.objects.filter(till__in=tills)):
+            counts.setdefault(count.till_id, []).append(count)
+        return [TillSummary(till, counts.get(till.id, [])) for till in tills]
+
+
+# Batch operations for closing the venue. A till that can't be processed is reported by its id and skipped, the
+# others are written with a handful of bulk queries in one transaction.
+
+@transaction.atomic
+def stop_tills(ids):
+    # Returns the ids of the stopped tills and the errors of the others
+    tills = Till.objects.select_for_update().in_bulk(ids)
+    stopped = []
+    errors = {}
+    for id in ids:
+        till = tills.get(id)
+        if till is None:
+            errors[id] = "The till does not exist"
+        elif till.state != Till.OPEN:
+            errors[id] = f"{till} is in a state from which it cannot be stopped: {till.get_state_display()}"
+        else:
+            stopped.append(id)
+    Till.objects.filter(pk__in=stopped).update(state=Till.STOPPED, stoppedAt=datetime.now())
+    User.objects.filter(current_till__in=stopped).update(current_till=None)
+    return stopped, errors
+
+
+@transaction.atomic
+def close_tills(ids, amounts, manager):
+    # Saves the counted amounts, given as strings by count id, and closes the tills. Every count of a till needs an
+    # amount. Returns the ids of the closed tills and the errors of the others.
+    tills = Till.objects.select_for_update().in_bulk(ids)
+    counts = {}
+    for count in TillMoneyCount.objects.filter(till__in=tills.keys()).select_related("paymentMethod"):
+        counts.setdefault(count.till_id, []).append(count)
+    closed = []
+    changed = []
+    errors = {}
+    for id in ids:
+        till = tills.get(id)
+        if till is None:
+            errors[id] = "The till does not exist"
+            continue
+        if till.state != Till.STOPPED:
+            errors[id] = f"{till} is in a state from which it cannot be closed: {till.get_state_display()}"
+            continue
+        try:
+            for count in counts.get(id, []):
+                count.amount = Decimal(amounts[count.id])
+                if not count.amount.is_finite() or count.amount < 0:
+                    raise ValueError
+        except KeyError:
+            errors[id] = f"{till} is missing the count of {count.paymentMethod.name}"
+            continue
+        except (InvalidOperation, ValueError):
+            errors[id] = f"{till} has an invalid count of {count.paymentMethod.name}"
+            continue
+        closed.append(id)
+        changed += counts.get(id, [])
+    TillMoneyCount.objects.bulk_update(changed, ["amount"])
+    Till.objects.filter(pk__in=closed).update(state=Till.COUNTED, countedAt=datetime.now(), countedBy=manager)
+    return closed, errors
+
+
+def verify_ledger(count, full=False):
+    # Recomputes the digests and sums of a count's ledger and returns what doesn't match. Checks the entries after
+    # the last snapshot unless full, and whether the ledger still agrees with the payments and edits it records.
+    problems = []
+    entries = count.ledger.order_by("sequence")
+    snapshot = None if full else count.ledger_snapshots.select_related("entry").order_by("-entry__sequence").first()
+    if snapshot is None:
+        previous, sequence, paid, edited = "", 0, Decimal(0), Decimal(0)
+    else:
+        previous, sequence, paid, edited = snapshot.digest, snapshot.entry.sequence, snapshot.paid, snapshot.edited
+        entries = entries.filter(sequence__gt=sequence)
+
+    for entry in entries.select_related("snapshot").iterator():
+        sequence += 1
+        if entry.sequence != sequence:
+            problems.append(f"Entry {sequence} is missing")
+            sequence = entry.sequence
+        if entry.kind == TillLedgerEntry.OPENING:
+            paid, edited = entry.paid, entry.edited
+        elif entry.kind == TillLedgerEntry.EDIT:
+            edited += entry.amount
+        else:
+            paid += entry.amount
+        if (entry.paid, entry.edited) != (paid, edited):
+            problems.append(f"Entry {entry.sequence} has sums {entry.paid}/{entry.edited}, expected {paid}/{edited}")
+        digest = TillLedgerEntry.compute_digest(previous, entry.sequence, entry.kind, entry.amount, entry.paid,
+                                                entry.edited, entry.source)
+        if entry.digest != digest:
+            problems.append(f"Entry {entry.sequence} has been altered")
+        snapshot = getattr(entry, "snapshot", None)
+        if snapshot is not None and (snapshot.paid, snapshot.edited, snapshot.digest) != \
+                (entry.paid, entry.edited, entry.digest):
+            problems.append(f"The snapshot at entry {entry.sequence} doesn't match it")
+        previous, paid, edited = entry.digest, entry.paid, entry.edited
+
+    payments = count.paymentintab_set.aggregate(sum=models.Sum("amount"))["sum"] or Decimal(0)
+    edits = count.tilledit_set.aggregate(sum=models.Sum("amount"))["sum"] or Decimal(0)
+    if (paid, edited) != (payments, edits):
+        problems.append(f"The ledger sums {paid}/{edited} differ from the payments and edits {payments}/{edits}")
+    return problems
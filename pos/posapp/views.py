@@ -16,8 +16,6 @@ from PIL import Image, UnidentifiedImageError
 # Create your views here.
 from PyPDF2 import PdfFileReader
 from PyPDF2.utils import PdfReadError
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django import views
 from django.conf import settings
 from django.contrib import messages
@@ -25,21 +23,25 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-from django.db.models import Q, ProtectedError
+from django.db.models import Q, ProtectedError, Count, Sum, Exists, OuterRef, F
 from django.db.transaction import atomic
 from django.http import HttpResponseForbidden, HttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
+from django.utils import timezone
 from django_fsm import has_transition_perm
 from django_fsm_log.models import StateLog
 
+from posapp import counters, presence
 from posapp.forms import CreateUserForm, CreatePaymentMethodForm, CreateEditProductForm, ItemsInProductFormSet, \
     CreateItemForm, AuthenticationForm, CreateEditDepositForm, CreateEditExpenseForm, CreateEditMemberForm
 from posapp.models import Tab, ProductInTab, Product, User, Currency, Till, Deposit, TillMoneyCount, \
     PaymentInTab, PaymentMethod, UnitGroup, Unit, ItemInProduct, Item, OrderVoidRequest, TabTransferRequest, Expense, \
-    Member
+    Member, Ticket, OutboxMessage, TillEdit
+from posapp.pagination import apply_cursor, encode_cursor
 from posapp.security.role_decorators import WaiterLoginRequiredMixin, ManagerLoginRequiredMixin, \
     DirectorLoginRequiredMixin
+from posapp.tills import TillSummary, stop_tills, close_tills
 
 logger = logging.getLogger(__name__)
 
@@ -94,8 +96,8 @@ class Context:
         self.data = {}
 
         if self.manager_role:
-            unresolved_requests = OrderVoidRequest.objects.filter(resolution__isnull=True)
-            count = len(unresolved_requests)
+            counts = counters.get_counts(counters.VOID_REQUESTS, counters.TRANSFER_REQUESTS)
+            count = counts[counters.VOID_REQUESTS]
             if count == 1:
                 self.notifications.append(
                     Notification(count, "1 Void request", "trash", reverse("manager/requests/void"))
@@ -105,8 +107,7 @@ class Context:
                     Notification(count, f"{count} void requests", "trash", reverse("manager/requests/void"))
                 )
 
-            unresolved_requests = TabTransferRequest.objects.all()
-            count = len(unresolved_requests)
+            count = counts[counters.TRANSFER_REQUESTS]
             if count == 1:
                 self.notifications.append(
                     Notification(count, "1 Tab transfer request", "people-arrows", reverse("manager/requests"))
@@ -159,6 +160,41 @@ class Context:
         if page_length not in self[key]["pages"]["page_length"]["options"]:
             self[key]["pages"]["page_length"]["options"].append(page_length)
 
+    def add_keyset_pagination_context(self, queryset, key, field, cursor_get_name="before",
+                                      page_length_get_name="page_length"):
+        try:
+            page_length = min(max(int(self.request.GET.get(page_length_get_name, 20)), 1), 1000)
+        except ValueError:
+            page_length = 20
+        cursor = self.request.GET.get(cursor_get_name, "")
+
+        try:
+            queryset = apply_cursor(queryset, field, cursor)
+        except ValueError:
+            cursor = ""
+            queryset = apply_cursor(queryset, field)
+
+        data = list(queryset[:page_length + 1])
+        show_next = len(data) > page_length
+        data = data[:page_length]
+
+        self[key] = {
+            "data": data,
+            "pages": {
+                "cursor": cursor,
+                "showFirst": bool(cursor),
+                "showNext": show_next,
+                "next": encode_cursor(data[-1], field) if show_next else "",
+                "page_length": {
+                    "options": [5, 10, 20, 50, 100, 200, 500],
+                    "value": page_length,
+                },
+            },
+        }
+
+        if page_length not in self[key]["pages"]["page_length"]["options"]:
+            self[key]["pages"]["page_length"]["options"].append(page_length)
+
     def add_timeline_context(self, items, key, time_label_classes='bg-danger', reverse=False):
         items = sorted(items, key=lambda item: item.timestamp, reverse=reverse)
         dates = []
@@ -205,77 +241,123 @@ def check_dict(dictionary, keys):
     return True
 
 
-def prepare_tab_dict(tab):
-    variance = tab.variance
-    out = {
-        'name': tab.name,
-        'id': tab.id,
-        'total': tab.total,
-        'paid': tab.paid,
-        'owner': tab.owner,
-        'variance': abs(variance),
-        'showVariance': variance != 0,
-        'varianceLabel': 'To pay' if variance > 0 else 'To change',
-        'showFinaliseAuto': variance == 0,
-        'showFinaliseChange': variance < 0,
-        'products': []
-    }
-
-    order_list = ProductInTab.objects.filter(tab=tab)
+def get_quantity(request, default=None):
+    # ?quantity=n makes an order action apply to only part of the order
+    try:
+        return int(request.GET["quantity"]) if "quantity" in request.GET else default
+    except ValueError:
+        raise ValidationError("The quantity must be a whole number")
+
+
+ORDER_STATE_KEYS = {
+    ProductInTab.ORDERED: ("orderedCount", "showOrdered"),
+    ProductInTab.PREPARING: ("preparingCount", "showPreparing"),
+    ProductInTab.TO_SERVE: ("toServeCount", "showToServe"),
+    ProductInTab.SERVED: ("servedCount", "showServed"),
+}
+
+
+def group_tab_products(rows, orders=None):
+    # rows come from grouped_tab_orders, orders (if any) are listed under the variant they belong to
     products = {}
-    for order in order_list:
-        if order.product.id not in products:
-            products[order.product.id] = {
-                'id': order.product.id,
-                'name': order.product.name,
-                'variants': {},
-            }
-
-        if order.note not in products[order.product.id]['variants']:
-            products[order.product.id]['variants'][order.note] = {
-                'note': order.note,
-                'orderedCount': 0,
-                'preparingCount': 0,
-                'toServeCount': 0,
-                'servedCount': 0,
-                'showOrdered': False,
-                'showPreparing': False,
-                'showToServe': False,
-                'showServed': False,
-                'total': 0,
-                'orders': [],
-            }
-
-        if order.state == ProductInTab.ORDERED:
-            products[order.product.id]['variants'][order.note]['orderedCount'] += 1
-            products[order.product.id]['variants'][order.note]['showOrdered'] = True
-        elif order.state == ProductInTab.PREPARING:
-            products[order.product.id]['variants'][order.note]['preparingCount'] += 1
-            products[order.product.id]['variants'][order.note]['showPreparing'] = True
-        elif order.state == ProductInTab.TO_SERVE:
-            products[order.product.id]['variants'][order.note]['toServeCount'] += 1
-            products[order.product.id]['variants'][order.note]['showToServe'] = True
-        elif order.state == ProductInTab.SERVED:
-            products[order.product.id]['variants'][order.note]['servedCount'] += 1
-            products[order.product.id]['variants'][order.note]['showServed'] = True
-
-        products[order.product.id]['variants'][order.note]['orders'].append(order)
-        products[order.product.id]['variants'][order.note]['total'] += order.price
-
-    for product_id in products:
-        variants = []
-        for variant in products[product_id]['variants']:
-            variants.append(products[product_id]['variants'][variant])
-
-        out['products'].append({
-            'id': products[product_id]['id'],
-            'name': products[product_id]['name'],
-            'variants': variants,
+    for row in rows:
+        product = products.setdefault(row["product"], {
+            'id': row["product"],
+            'name': row["product__name"],
+            'variants': {},
+        })
+        variant = product['variants'].setdefault(row["note"], {
+            'note': row["note"],
+            'orderedCount': 0,
+            'preparingCount': 0,
+            'toServeCount': 0,
+            'servedCount': 0,
+            'showOrdered': False,
+            'showPreparing': False,
+            'showToServe': False,
+            'showServed': False,
+            'total': 0,
+            'orders': [],
+        })
+        if row["state"] in ORDER_STATE_KEYS:
+            count_key, show_key = ORDER_STATE_KEYS[row["state"]]
+            variant[count_key] += row["count"]
+            variant[show_key] = True
+            variant['total'] += row["total"]
+
+    for order in orders or []:
+        if order.product_id in products and order.note in products[order.product_id]['variants']:
+            products[order.product_id]['variants'][order.note]['orders'].append(order)
+
+    return [{
+        'id': product['id'],
+        'name': product['name'],
+        'variants': list(product['variants'].values()),
+    } for product in products.values()]
+
+
+def grouped_tab_orders(tabs):
+    return ProductInTab.objects.filter(tab__in=tabs) \
+        .values("tab", "product", "product__name", "note", "state") \
+        .annotate(count=Sum("quantity"), total=ProductInTab.SUM_PRICE) \
+        .order_by("product__name", "product", "note", "state")
+
+
+def tab_order_rows(tabs):
+    open_void_requests = OrderVoidRequest.objects.filter(order=OuterRef("pk"), resolution__isnull=True)
+    return ProductInTab.objects.filter(tab__in=tabs) \
+        .annotate(open_void_request=Exists(open_void_requests)) \
+        .order_by("orderedAt")
+
+
+def prepare_tab_dicts(tabs, include_orders=False):
+    tabs = list(tabs)
+
+    rows = {}
+    for row in grouped_tab_orders(tabs):
+        rows.setdefault(row["tab"], []).append(row)
+
+    orders = {}
+    if include_orders:
+        for order in tab_order_rows(tabs):
+            orders.setdefault(order.tab_id, []).append(order)
+
+    out = []
+    for tab in tabs:
+        variance = tab.variance
+        out.append({
+            'name': tab.name,
+            'id': tab.id,
+            'version': tab.version,
+            'total': tab.total,
+            'paid': tab.paid,
+            'owner': tab.owner,
+            'variance': abs(variance),
+            'showVariance': variance != 0,
+            'varianceLabel': 'To pay' if variance > 0 else 'To change',
+            'showFinaliseAuto': variance == 0,
+            'showFinaliseChange': variance < 0,
+            'products': group_tab_products(rows.get(tab.id, []), orders.get(tab.id) if include_orders else None),
         })
-
     return out
 
 
+def group_by_ticket(orders):
+    # Tickets keep the position of their first row, rows without a ticket stay on their own
+    tickets = {}
+    for order in orders:
+        tickets.setdefault(order.ticket_id or order.id, {
+            'id': order.ticket_id,
+            'tab': order.tab,
+            'orders': [],
+        })['orders'].append(order)
+    return list(tickets.values())
+
+
+def prepare_tab_dict(tab, include_orders=True):
+    return prepare_tab_dicts([tab], include_orders)[0]
+
+
 def base_method(method):
     method.is_base = True
     return method
@@ -559,16 +641,11 @@ class Index(LoginRequiredMixin, DisambiguationView):
         class Tabs(WaiterLoginRequiredMixin, BaseView):
             def get(self, *args, **kwargs):
                 context = Context(self.request, "waiter/tabs/index.html", "Tabs")
-                tabs = []
-                tabs_list = Tab.objects.filter(state=Tab.OPEN, temp_tab_owner__isnull=True)
-                for tab in tabs_list:
-                    tabs.append(prepare_tab_dict(tab))
+                tabs = Tab.objects.filter(state=Tab.OPEN, temp_tab_owner__isnull=True).select_related("owner") \
+                    .order_by("openedAt")
 
-                context['tabs'] = tabs
+                context['tabs'] = prepare_tab_dicts(tabs)
                 context['products'] = Product.objects.filter(enabled=True)
-
-                if self.request.user.is_manager:
-                    context['paid_tabs'] = Tab.objects.filter(state=Tab.PAID)
                 return context.render()
 
             def post(self, *args, **kwargs):
@@ -619,23 +696,23 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                     transfer_request.tab = tab
                                     transfer_request.requester = self.request.user
                                     transfer_request.new_owner = new_owner
-                                    transfer_request.clean()
-                                    transfer_request.save()
-                                    channel_layer = get_channel_layer()
-                                    async_to_sync(channel_layer.group_send)(
-                                        "notifications_manager",
-                                        {
-                                            "type": "notification.tab_transfer_request",
-                                            "tab_transfer_request": {
-                                                "notification_type": "tab_transfer_request",
-                                                "request_id": str(transfer_request.id),
-                                                "tab_name": transfer_request.tab.name,
-                                                "requester_name": transfer_request.requester.name,
-                                                "new_owner_name": transfer_request.new_owner.name,
-                                                "transfer_mode": "transfer",
+                                    with atomic():
+                                        transfer_request.clean()
+                                        transfer_request.save()
+                                        OutboxMessage.enqueue(
+                                            "notifications_manager",
+                                            {
+                                                "type": "notification.tab_transfer_request",
+                                                "tab_transfer_request": {
+                                                    "notification_type": "tab_transfer_request",
+                                                    "request_id": str(transfer_request.id),
+                                                    "tab_name": transfer_request.tab.name,
+                                                    "requester_name": transfer_request.requester.name,
+                                                    "new_owner_name": transfer_request.new_owner.name,
+                                                    "transfer_mode": "transfer",
+                                                },
                                             },
-                                        },
-                                    )
+                                        )
                                     messages.success(self.request,
                                                      f"A transfer to user {new_owner.name} was requested.")
                                 else:
@@ -663,23 +740,23 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                 transfer_request.tab = tab
                                 transfer_request.requester = self.request.user
                                 transfer_request.new_owner = self.request.user
-                                transfer_request.clean()
-                                transfer_request.save()
-                                channel_layer = get_channel_layer()
-                                async_to_sync(channel_layer.group_send)(
-                                    "notifications_manager",
-                                    {
-                                        "type": "notification.tab_transfer_request",
-                                        "tab_transfer_request": {
-                                            "notification_type": "tab_transfer_request",
-                                            "request_id": str(transfer_request.id),
-                                            "tab_name": transfer_request.tab.name,
-                                            "requester_name": transfer_request.requester.name,
-                                            "new_owner_name": transfer_request.new_owner.name,
-                                            "transfer_mode": "claim",
+                                with atomic():
+                                    transfer_request.clean()
+                                    transfer_request.save()
+                                    OutboxMessage.enqueue(
+                                        "notifications_manager",
+                                        {
+                                            "type": "notification.tab_transfer_request",
+                                            "tab_transfer_request": {
+                                                "notification_type": "tab_transfer_request",
+                                                "request_id": str(transfer_request.id),
+                                                "tab_name": transfer_request.tab.name,
+                                                "requester_name": transfer_request.requester.name,
+                                                "new_owner_name": transfer_request.new_owner.name,
+                                                "transfer_mode": "claim",
+                                            },
                                         },
-                                    },
-                                )
+                                    )
                                 messages.success(self.request, f"A claim was requested.")
                             else:
                                 messages.warning(self.request, f"The tab owner can't request claims on his own tabs.")
@@ -714,13 +791,35 @@ class Index(LoginRequiredMixin, DisambiguationView):
                         return redirect(reverse("waiter/tabs/tab", kwargs={"id": id}))
 
         class Orders(WaiterLoginRequiredMixin, BaseView):
+            SERVED_WINDOW = datetime.timedelta(hours=2)
+
+            @staticmethod
+            def fill_board(context):
+                orders = ProductInTab.objects.select_related("product", "tab")
+                context["waiting"] = group_by_ticket(
+                    orders.filter(state=ProductInTab.ORDERED).order_by("orderedAt"))
+                context["preparing"] = group_by_ticket(
+                    orders.filter(state=ProductInTab.PREPARING).order_by("preparingAt"))
+                context["prepared"] = group_by_ticket(
+                    orders.filter(state=ProductInTab.TO_SERVE).order_by("preparedAt"))
+                context["served"] = orders.filter(
+                    state=ProductInTab.SERVED,
+                    servedAt__gte=timezone.now() - Index.Waiter.Orders.SERVED_WINDOW,
+                ).order_by("-servedAt")
+                context["served_hours"] = int(Index.Waiter.Orders.SERVED_WINDOW.total_seconds() // 3600)
+                return context
+
             def get(self, *args, **kwargs):
                 context = Context(self.request, "waiter/orders/index.html", "Orders")
-                context["waiting"] = ProductInTab.objects.filter(state=ProductInTab.ORDERED).order_by("orderedAt")
-                context["preparing"] = ProductInTab.objects.filter(state=ProductInTab.PREPARING).order_by("preparingAt")
-                context["prepared"] = ProductInTab.objects.filter(state=ProductInTab.TO_SERVE).order_by("preparedAt")
-                context["served"] = ProductInTab.objects.filter(state=ProductInTab.SERVED).order_by("orderedAt")
-                return context.render()
+                return Index.Waiter.Orders.fill_board(context).render()
+
+            # Only the columns, a kitchen display fetches these whenever the orders socket reports a change
+            class Board(WaiterLoginRequiredMixin, BaseView):
+                _advertise = False
+
+                def get(self, *args, **kwargs):
+                    context = Context(self.request, "waiter/orders/board.html", "Orders")
+                    return Index.Waiter.Orders.fill_board(context).render()
 
             class Order(WaiterLoginRequiredMixin, BaseView):
                 _url = "<uuid:id>"
@@ -736,8 +835,9 @@ class Index(LoginRequiredMixin, DisambiguationView):
                     def get(self, id, count, *args, **kwargs):
                         try:
                             product = ProductInTab.objects.get(id=id)
+                            quantity = get_quantity(self.request)
                             for i in range(count):
-                                if not product.bump():
+                                if not product.bump(quantity):
                                     messages.warning(self.request,
                                                      "You attempted to bump the order beyond its capabilities, "
                                                      "it can only take so much.")
@@ -752,37 +852,40 @@ class Index(LoginRequiredMixin, DisambiguationView):
                     def get(self, id, *args, **kwargs):
                         try:
                             order = ProductInTab.objects.get(id=id)
-                            void_request = OrderVoidRequest(order=order, waiter=self.request.user)
-                            void_request.clean()
-                            void_request.save()
-                            channel_layer = get_channel_layer()
-                            async_to_sync(channel_layer.group_send)(
-                                "notifications_manager",
-                                {
-                                    "type": "notification.void_request",
-                                    "void_request": {
-                                        "notification_type": "void_request",
-                                        "request_id": str(void_request.id),
-                                        "user": {
-                                            "first_name": void_request.waiter.first_name,
-                                            "last_name": void_request.waiter.last_name,
-                                            "username": void_request.waiter.username,
-                                        },
-                                        "order": {
-                                            "id": str(void_request.order.id),
-                                            "product_name": void_request.order.product.name,
-                                            "state": void_request.order.state,
-                                            "ordered_at": str(void_request.order.orderedAt),
-                                            "preparing_at": str(void_request.order.preparingAt),
-                                            "prepared_at": str(void_request.order.preparedAt),
-                                            "served_at": str(void_request.order.servedAt),
-                                            "note": void_request.order.note,
-                                            "tab_name": void_request.order.tab.name,
+                            void_request = OrderVoidRequest(order=order, quantity=get_quantity(self.request, 1),
+                                                            waiter=self.request.user)
+                            with atomic():
+                                void_request.clean()
+                                void_request.save()
+                                OutboxMessage.enqueue(
+                                    "notifications_manager",
+                                    {
+                                        "type": "notification.void_request",
+                                        "void_request": {
+                                            "notification_type": "void_request",
+                                            "request_id": str(void_request.id),
+                                            "user": {
+                                                "first_name": void_request.waiter.first_name,
+                                                "last_name": void_request.waiter.last_name,
+                                                "username": void_request.waiter.username,
+                                            },
+                                            "order": {
+                                                "id": str(void_request.order.id),
+                                                "product_name": void_request.order.product.name,
+                                                "quantity": void_request.quantity,
+                                                "state": void_request.order.state,
+                                                "ordered_at": str(void_request.order.orderedAt),
+                                                "preparing_at": str(void_request.order.preparingAt),
+                                                "prepared_at": str(void_request.order.preparedAt),
+                                                "served_at": str(void_request.order.servedAt),
+                                                "note": void_request.order.note,
+                                                "tab_name": void_request.order.tab.name,
+                                            }
                                         }
-                                    }
-                                },
-                            )
-                            messages.success(self.request, f"Void of a {order.product.name} requested")
+                                    },
+                                )
+                            messages.success(self.request,
+                                             f"Void of {void_request.quantity}× {order.product.name} requested")
                         except ValidationError as err:
                             return ErrorView(self.request, 500, comment=err.message).render()
                         except ProductInTab.DoesNotExist:
@@ -794,8 +897,8 @@ class Index(LoginRequiredMixin, DisambiguationView):
                     def get(self, id, *args, **kwargs):
                         try:
                             order = ProductInTab.objects.get(id=id)
-                            order.void()
-                            messages.success(self.request, f"Order of a {order.product.name} voided")
+                            order.void(get_quantity(self.request, 1))
+                            messages.success(self.request, f"Order of {order.quantity}× {order.product.name} voided")
                         except ProductInTab.DoesNotExist:
                             return ErrorView(self.request, 404, title="Order").render()
                         except ValidationError as err:
@@ -814,6 +917,7 @@ class Index(LoginRequiredMixin, DisambiguationView):
                             context["id"] = id
                             context["order"] = ProductInTab.objects.get(id=id)
                             context["form"] = AuthenticationForm()
+                            context["quantity"] = self.request.GET.get("quantity", 1)
                             if "next" in self.request.GET:
                                 context["next"] = self.request.GET["next"]
                             return context.render()
@@ -827,8 +931,9 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                 form = AuthenticationForm(data=self.request.POST)
                                 if form.is_valid() and (user := form.authenticate()):
                                     if user.is_manager:
-                                        order.void()
-                                        messages.success(self.request, f"Order of a {order.product.name} voided")
+                                        order.void(get_quantity(self.request, 1))
+                                        messages.success(self.request,
+                                                         f"Order of {order.quantity}× {order.product.name} voided")
                                     else:
                                         messages.warning(self.request, "Only managers can directly void items. "
                                                                        "Please enter credentials of a manager.")
@@ -847,6 +952,35 @@ class Index(LoginRequiredMixin, DisambiguationView):
                         return redirect(
                             self.request.GET["next"] if "next" in self.request.GET else reverse("waiter/orders"))
 
+            class Ticket(WaiterLoginRequiredMixin, BaseView):
+                _url = "tickets/<uuid:id>"
+                _advertise = False
+
+                def get(self, id, *args, **kwargs):
+                    return redirect(reverse("waiter/orders"))
+
+                class Bump(WaiterLoginRequiredMixin, BaseView):
+                    def get(self, id, *args, **kwargs):
+                        try:
+                            ticket = Ticket.objects.get(id=id)
+                            if not ticket.bump(self.request.GET.get("state")):
+                                messages.warning(self.request, "There was nothing left to bump on this ticket.")
+                        except Ticket.DoesNotExist:
+                            return ErrorView(self.request, 404, title="Ticket").render()
+                        return redirect(
+                            self.request.GET["next"] if "next" in self.request.GET else reverse("waiter/orders"))
+
+                class Void(ManagerLoginRequiredMixin, BaseView):
+                    def get(self, id, *args, **kwargs):
+                        try:
+                            ticket = Ticket.objects.get(id=id)
+                            count = ticket.void()
+                            messages.success(self.request, f"{count} order(s) of the ticket voided")
+                        except Ticket.DoesNotExist:
+                            return ErrorView(self.request, 404, title="Ticket").render()
+                        return redirect(
+                            self.request.GET["next"] if "next" in self.request.GET else reverse("waiter/orders"))
+
         class Direct(WaiterLoginRequiredMixin, BaseView):
             _name = "Direct order"
 
@@ -953,6 +1087,10 @@ class Index(LoginRequiredMixin, DisambiguationView):
                 context['me'] = self.request.user.username
                 context['search'] = search
                 context.add_pagination_context(users, 'users')
+                context['users']['data'] = list(context['users']['data'])
+                online = presence.get_store().counts([user.username for user in context['users']['data']])
+                for user in context['users']['data']:
+                    user.online_count = online[user.username]
 
                 return context.render()
 
@@ -1050,33 +1188,25 @@ class Index(LoginRequiredMixin, DisambiguationView):
                 search = self.request.GET.get("search", "")
                 deposit_filter = self.request.GET.get("deposit_filter", "")
 
-                open_tills = Till.objects.filter(state=Till.OPEN).filter(
-                    Q(cashiers__first_name__icontains=search) |
-                    Q(cashiers__last_name__icontains=search) |
-                    Q(cashiers__username__icontains=search)
-                )
-                stopped_tills = Till.objects.filter(state=Till.STOPPED).filter(
-                    Q(cashiers__first_name__icontains=search) |
-                    Q(cashiers__last_name__icontains=search) |
-                    Q(cashiers__username__icontains=search)
-                )
-                counted_tills = Till.objects.filter(state=Till.COUNTED).filter(
-                    Q(cashiers__first_name__icontains=search) |
-                    Q(cashiers__last_name__icontains=search) |
-                    Q(cashiers__username__icontains=search)
-                )
+                # Searched through a subquery, joining the cashiers would repeat tills and limit the aggregated names
+                # to the matching cashiers
+                tills = Till.objects.all()
+                if search:
+                    tills = tills.filter(Exists(User.objects.filter(
+                        Q(first_name__icontains=search) | Q(last_name__icontains=search) |
+                        Q(username__icontains=search),
+                        tills_owned=OuterRef("pk"),
+                    )))
 
-                deposits = set()
-                deposits.update(open_tills.values_list('deposit', flat=True))
-                deposits.update(stopped_tills.values_list('deposit', flat=True))
-                deposits.update(counted_tills.values_list('deposit', flat=True))
-                context["deposits"] = deposits
+                context["deposits"] = tills.order_by("deposit").values_list("deposit", flat=True).distinct()
                 context["deposit_filter"] = deposit_filter
 
                 if deposit_filter:
-                    open_tills = open_tills.filter(deposit__exact=deposit_filter)
-                    stopped_tills = stopped_tills.filter(deposit__exact=deposit_filter)
-                    counted_tills = counted_tills.filter(deposit__exact=deposit_filter)
+                    tills = tills.filter(deposit__exact=deposit_filter)
+                tills = Till.with_cashier_names(tills).order_by("openedAt")
+                open_tills = tills.filter(state=Till.OPEN)
+                stopped_tills = tills.filter(state=Till.STOPPED)
+                counted_tills = tills.filter(state=Till.COUNTED)
                 context.add_pagination_context(open_tills, 'open', page_get_name="page_open",
                                                page_length_get_name="page_length_open")
                 context.add_pagination_context(stopped_tills, 'stopped', page_get_name="page_stopped",
@@ -1105,27 +1235,29 @@ class Index(LoginRequiredMixin, DisambiguationView):
                         options_id = self.request.POST["options"]
 
                         try:
-                            options = Deposit.objects.get(id=uuid.UUID(options_id))
-                            if options.enabled:
-                                till = options.create_till()
-                            else:
-                                messages.error(self.request, 'Can not create Till from disabled Deposit')
-                            for username in usernames:
-                                user = User.objects.get(username=username)
-                                if user.current_till:
-                                    messages.warning(self.request,
-                                                     f"The user {user} was excluded from this Till "
-                                                     f"as they already have another Till assigned.")
-                                else:
+                            with atomic():
+                                options = Deposit.objects.get(id=uuid.UUID(options_id))
+                                # Locked, so another manager can't give them a till meanwhile
+                                users = User.objects.select_for_update().in_bulk(usernames, field_name="username")
+                                if len(users) != len(set(usernames)):
+                                    raise User.DoesNotExist
+                                cashiers = []
+                                for user in users.values():
+                                    if user.current_till_id:
+                                        messages.warning(self.request,
+                                                         f"The user {user} was excluded from this Till "
+                                                         f"as they already have another Till assigned.")
+                                        continue
                                     try:
-                                        user.current_till = till
                                         user.clean()
-                                        user.save()
-                                        till.cashiers.add(user)
+                                        cashiers.append(user)
                                     except ValidationError as err:
                                         messages.warning(self.request, f"The user {user} was not added to this Till: "
                                                                        f"{err.message}")
-                            messages.success(self.request, "The till was assigned successfully")
+                                if options.create_till(cashiers):
+                                    messages.success(self.request, "The till was assigned successfully")
+                                else:
+                                    messages.error(self.request, 'Can not create Till from disabled Deposit')
                         except User.DoesNotExist:
                             messages.error(self.request, "One of the selected users does not exist")
                         except Deposit.DoesNotExist:
@@ -1143,6 +1275,47 @@ class Index(LoginRequiredMixin, DisambiguationView):
 
                     return context.render()
 
+            class EndOfNight(ManagerLoginRequiredMixin, BaseView):
+                _name = "End of night"
+
+                def get(self, *args, **kwargs):
+                    context = Context(self.request, "manager/tills/end_of_night.html", "End of night")
+                    context["open_tills"] = Till.with_cashier_names(Till.objects.filter(state=Till.OPEN)) \
+                        .order_by("openedAt")
+                    stopped = Till.with_cashier_names(Till.objects.filter(state=Till.STOPPED))
+                    context["stopped_tills"] = TillSummary.for_tills(list(stopped.order_by("stoppedAt", "openedAt")))
+                    return context.render()
+
+                def post(self, *args, **kwargs):
+                    ids = []
+                    for value in self.request.POST.getlist("tills"):
+                        try:
+                            ids.append(uuid.UUID(value))
+                        except ValueError:
+                            messages.warning(self.request, f"{value} is not a till id, skipping.")
+                    if "stop" in self.request.POST:
+                        done, errors = stop_tills(ids)
+                        if done:
+                            messages.success(self.request, f"{len(done)} till(s) stopped. They are now available "
+                                                           f"for counting.")
+                    elif "close" in self.request.POST:
+                        amounts = {}
+                        for key, value in self.request.POST.items():
+                            if key.startswith("counted-"):
+                                try:
+                                    amounts[uuid.UUID(key[len("counted-"):])] = value
+                                except ValueError:
+                                    pass
+                        done, errors = close_tills(ids, amounts, self.request.user)
+                        if done:
+                            messages.success(self.request, f"{len(done)} till(s) counted and closed.")
+                    else:
+                        messages.error(self.request, "Choose whether to stop or to close the selected tills")
+                        errors = {}
+                    for error in errors.values():
+                        messages.warning(self.request, error)
+                    return redirect(reverse("manager/tills/end_of_night"))
+
             class Till(ManagerLoginRequiredMixin, BaseView):
                 _url = "<uuid:id>"
                 _advertise = False
@@ -1157,32 +1330,24 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                 comment=f"It is not allowed to display a till in the state {till.get_state_display()}"
                             ).render()
                         context["id"] = id
-                        counts = till.tillmoneycount_set.all()
-                        context["counts"] = []
-                        context["edits"] = []
-                        context["totals"] = {"expected": 0, "counted": 0, "variance": 0}
-
-                        for count in counts:
-                            expected = count.expected
-                            counted = count.counted
-                            variance = counted - expected
-                            context["counts"].append({
-                                "methodName": count.paymentMethod.name,
-                                "expected": expected,
-                                "counted": counted,
-                                "variance": variance,
-                                "varianceUp": variance > 0,
-                                "varianceDown": variance < 0,
-                            })
-                            context["totals"]["expected"] += expected
-                            context["totals"]["counted"] += counted
-                            context["totals"]["variance"] += variance
-
-                            for edit in count.tilledit_set.order_by('transaction__timestamp').all():
-                                context["edits"].append(edit)
-
-                        context["totals"]["varianceDown"] = context["totals"]["variance"] < 0
-                        context["totals"]["varianceUp"] = context["totals"]["variance"] > 0
+                        summary = TillSummary(till)
+                        context["counts"] = [{
+                            "methodName": count.paymentMethod.name,
+                            "expected": count.expected_amount,
+                            "counted": count.counted_amount,
+                            "variance": count.variance,
+                            "varianceUp": count.variance > 0,
+                            "varianceDown": count.variance < 0,
+                        } for count in summary.counts]
+                        context["edits"] = TillEdit.objects.filter(count__till=till) \
+                            .select_related("count__paymentMethod").order_by("created")
+                        context["totals"] = {
+                            "expected": summary.expected,
+                            "counted": summary.counted,
+                            "variance": summary.variance,
+                            "varianceDown": summary.variance < 0,
+                            "varianceUp": summary.variance > 0,
+                        }
 
                         context["till"] = {
                             "cashiers": [],
@@ -1225,16 +1390,16 @@ class Index(LoginRequiredMixin, DisambiguationView):
                         try:
                             till = Till.objects.get(id=id)
 
-                            counts = till.tillmoneycount_set.all()
+                            summary = TillSummary(till)
                             context["counts"] = []
                             context["totals"] = {
                                 "counted": 0,
-                                "expected": 0,
+                                "expected": summary.expected,
                                 "variance": 0,
                             }
-                            for count in counts:
-                                expected = count.expected
-                                variance = count.amount - expected
+                            # Only the amounts being counted, edits come after counting
+                            for count in summary.counts:
+                                variance = count.amount - count.expected_amount
                                 if variance > 0:
                                     warn = "The counted amount is higher than expected"
                                 elif variance < 0:
@@ -1246,13 +1411,12 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                     "id": count.id,
                                     "name": count.paymentMethod.name,
                                     "amount": count.amount,
-                                    "expected": expected,
+                                    "expected": count.expected_amount,
                                     "variance": variance,
                                     "warn": warn,
                                     "zeroed": count.id in zeroed,
                                 })
                                 context["totals"]["counted"] += count.amount
-                                context["totals"]["expected"] += expected
                                 context["totals"]["variance"] += variance
                             if context["totals"]["variance"] > 0:
                                 context["totals"]["warn"] = "The total is higher than expected"
@@ -1270,7 +1434,7 @@ class Index(LoginRequiredMixin, DisambiguationView):
                         till = Till.objects.get(id=id)
                         zeroed = []
 
-                        counts = till.tillmoneycount_set.all()
+                        counts = till.tillmoneycount_set.select_related("paymentMethod")
                         for count in counts:
                             count.amount = float(self.request.POST[f"counted-{count.id}"])
                             if count.amount < 0:
@@ -1312,7 +1476,7 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                     comment=f"It is not allowed to edit a till in the state {till.get_state_display()}"
                                 ).render()
                             context["id"] = id
-                            context["counts"] = till.tillmoneycount_set.all()
+                            context["counts"] = TillSummary(till).counts
                         except Till.DoesNotExist:
                             return ErrorView(self.request, 404, title="Till").render()
 
@@ -1350,12 +1514,42 @@ class Index(LoginRequiredMixin, DisambiguationView):
                                 except ValidationError as err:
                                     messages.error(self.request, f"Creating Till edit failed: {err.message}")
                             context["id"] = id
-                            context["counts"] = till.tillmoneycount_set.all()
+                            context["counts"] = TillSummary(till).counts
                         except Till.DoesNotExist:
                             return ErrorView(self.request, 404, title="Till").render()
 
                         return context.render()
 
+        class TabHistory(ManagerLoginRequiredMixin, BaseView):
+            _name = "Tab history"
+
+            def get(self, *args, **kwargs):
+                context = Context(self.request, "manager/tab_history/index.html", "Tab history")
+                owner_filter = self.request.GET.get("owner", "")
+                date_from = self.request.GET.get("date_from", "")
+                date_to = self.request.GET.get("date_to", "")
+
+                tabs = Tab.objects.filter(state=Tab.PAID).select_related("owner") \
+                    .annotate(total_price=F("orderedTotal") - F("voidedTotal"))
+                if owner_filter:
+                    tabs = tabs.filter(owner__username=owner_filter)
+                try:
+                    if date_from:
+                        start = datetime.datetime.combine(datetime.date.fromisoformat(date_from), datetime.time.min)
+                        tabs = tabs.filter(closedAt__gte=timezone.make_aware(start))
+                    if date_to:
+                        end = datetime.datetime.combine(datetime.date.fromisoformat(date_to), datetime.time.min)
+                        tabs = tabs.filter(closedAt__lt=timezone.make_aware(end + datetime.timedelta(days=1)))
+                except ValueError:
+                    messages.warning(self.request, "The date filter is not a valid date, ignoring.")
+
+                context.add_keyset_pagination_context(tabs, "tabs", "closedAt")
+                context["owners"] = User.objects.filter(is_waiter=True).order_by("last_name", "first_name")
+                context["owner_filter"] = owner_filter
+                context["date_from"] = date_from
+                context["date_to"] = date_to
+                return context.render()
+
         class Requests(ManagerLoginRequiredMixin, BaseView):
             def get(self, *args, **kwargs):
                 context = Context(self.request, "manager/requests/index.html", "Requests")
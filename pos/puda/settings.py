@@ -107,6 +107,39 @@ if os.environ.get("CHANNELS_HOST", ""):
 
     config["hosts"].append((os.environ.get("CHANNELS_HOST", ""), int(os.environ.get("CHANNELS_PORT", "0"))))
 
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    },
+}
+
+# Where websocket presence is tracked. It has to be shared by the socket, web and reaper processes, so in production
+# the default posapp.presence.CachePresenceStore needs a CACHE_BACKEND every process reaches (Redis, Memcached), the
+# default LocMemCache is per process. MemoryPresenceStore only works within a single process and
+# DatabasePresenceStore writes a row on every connect and heartbeat, use it only where no shared cache is available.
+# Pages send a heartbeat every 20 seconds, the TTL has to stay well above that.
+PRESENCE_STORE = os.environ.get("PRESENCE_STORE", "posapp.presence.CachePresenceStore")
+PRESENCE_TTL = int(os.environ.get("PRESENCE_TTL", "60"))
+# Seconds presence changes are collected for before managers get them in one message
+PRESENCE_BROADCAST_DELAY = float(os.environ.get("PRESENCE_BROADCAST_DELAY", "0.5"))
+
+# Whether web processes send committed outbox messages themselves. Turn it off when a dispatch_outbox command runs
+# instead. Failed sends are retried every OUTBOX_RETRY_INTERVAL seconds at most.
+OUTBOX_DISPATCH_IN_PROCESS = bool(int(os.environ.get("OUTBOX_DISPATCH_IN_PROCESS", "1")))
+OUTBOX_RETRY_INTERVAL = float(os.environ.get("OUTBOX_RETRY_INTERVAL", "5"))
+
+# Days user notifications are kept for replaying to sockets that missed them, see the prune_notifications command
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_RETENTION_DAYS", "7"))
+
+# Messages a stream socket sends before waiting for the client's acknowledgement, and messages it queues meanwhile
+# before closing the socket as too slow
+STREAM_SEND_WINDOW = int(os.environ.get("STREAM_SEND_WINDOW", "50"))
+STREAM_QUEUE_LIMIT = int(os.environ.get("STREAM_QUEUE_LIMIT", "200"))
+
+# Entries of a till count's ledger between two balance snapshots
+TILL_LEDGER_SNAPSHOT_INTERVAL = int(os.environ.get("TILL_LEDGER_SNAPSHOT_INTERVAL", "100"))
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 